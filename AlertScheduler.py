@@ -0,0 +1,88 @@
+import logging
+import queue
+import threading
+import time
+
+import RPi.GPIO as GPIO
+
+logger = logging.getLogger(__name__)
+
+
+class AlertScheduler:
+    def __init__(self, led_pin, dedup_window=60.0):
+        self.led_pin = led_pin
+        # Repeats of an alert within this many seconds of the last one are dropped
+        self.dedup_window = dedup_window
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # Alerts that are queued or currently playing
+        self.active = set()
+        # key -> monotonic time the alert last finished playing
+        self.last_played = {}
+        self.suppressed = 0
+
+        self.stop_event = threading.Event()
+
+        # Setup GPIO mode and pin
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(self.led_pin, GPIO.OUT)
+        GPIO.output(self.led_pin, GPIO.LOW)  # Start with LED off
+
+        self.worker = threading.Thread(target=self._run, name="AlertScheduler", daemon=True)
+        self.worker.start()
+
+    def notify(self, key='alert', duration=10.0, pattern=None) -> bool:
+        # pattern is a list of (on seconds, off seconds) steps, default is one solid on period
+        if pattern is None:
+            pattern = [(duration, 0)]
+
+        with self.lock:
+            last = self.last_played.get(key)
+            recent = last is not None and time.monotonic() - last < self.dedup_window
+            if key in self.active or recent:
+                self.suppressed += 1
+                return False
+            self.active.add(key)
+
+        self.queue.put((key, pattern))
+        return True
+
+    def blink(self, key='alert', on_time=0.5, off_time=0.5, count=10) -> bool:
+        return self.notify(key=key, pattern=[(on_time, off_time)] * count)
+
+    def _run(self) -> None:
+        while not self.stop_event.is_set():
+            item = self.queue.get()
+            if item is None:
+                break
+
+            key, pattern = item
+            try:
+                self._play(pattern)
+            except Exception:
+                # A failed GPIO write loses this alert, the worker stays up for the next ones
+                logger.exception("Playing alert %s failed", key)
+            finally:
+                with self.lock:
+                    self.active.discard(key)
+                    self.last_played[key] = time.monotonic()
+
+        GPIO.output(self.led_pin, GPIO.LOW)
+
+    def _play(self, pattern) -> None:
+        for on_time, off_time in pattern:
+            GPIO.output(self.led_pin, GPIO.HIGH)
+            logger.debug("LED ON")
+            # Waiting on the stop event lets close() cut a long pattern short
+            if self.stop_event.wait(on_time):
+                break
+            GPIO.output(self.led_pin, GPIO.LOW)
+            if off_time and self.stop_event.wait(off_time):
+                break
+        GPIO.output(self.led_pin, GPIO.LOW)
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.queue.put(None)
+        self.worker.join()
@@ -0,0 +1,315 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import FakeHardware
+
+# The fakes have to be in place before any module touching GPIO, the DHT sensor, SPI or the webcam is imported
+FakeHardware.install(spi=True)
+
+import cv2
+import numpy as np
+
+from Camera import Camera
+from ColumnStore import ColumnStore
+from DataHandler import DataHandler
+from HealthModel import HealthModel, GRID_EXACT
+from Humidity import TempHumidity
+from ImageWriter import ImageWriter
+from Moisture import Moisture
+from Ph import Ph
+from QueryServer import LiveCache
+from YellowDetector import YellowDetector
+from main import MonitoringSystem
+from Metrics import metrics
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_FILES = ['plant_health_xgb_model.ubj', 'plant_health_xgb_model.pkl']
+
+RESOLUTIONS = [(320, 240), (640, 480), (1280, 720), (1920, 1080)]
+
+# Largest yellowing percentage point difference from the mask implementation allowed per reduction,
+# full size must match exactly
+DETECTOR_TOLERANCE = {1: 0.0, 2: 0.5, 4: 1.0}
+
+
+def summarise(durations) -> dict:
+    # Latency percentiles in milliseconds
+    values = np.asarray(durations) * 1000
+    return {
+        'count': len(values),
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p90_ms': float(np.percentile(values, 90)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max()),
+    }
+
+
+def timed(function, durations):
+    # Wraps function so every call appends its duration to durations
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+    return wrapper
+
+
+def rate(function, min_seconds=1.0, batch=1) -> float:
+    # Calls per second of function, repeated for at least min_seconds
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return calls / elapsed
+
+
+def benchmark_cycle(cycles) -> dict:
+    stages = {'capture': [], 'detect_yellowing': [], 'predict_disease': [], 'write_data_entry': [], 'cycle': []}
+
+    image_writer = ImageWriter()
+    data_handler = DataHandler()
+    camera = Camera(image_writer=image_writer)
+    monitoring_system = MonitoringSystem(
+        data_handler=data_handler,
+        yellow_detector=YellowDetector(),
+        camera=camera,
+        moisture=Moisture(),
+        temp_humidity=TempHumidity(),
+        ph=Ph(),
+        health_model=HealthModel(),
+        interval=10,
+        alert_duration=0
+    )
+
+    # Time each stage on the real objects the monitoring cycle uses
+    camera.take_photo = timed(camera.take_photo, stages['capture'])
+    detector = monitoring_system.yellow_detector
+    detector.detect_yellowing = timed(detector.detect_yellowing, stages['detect_yellowing'])
+    health_model = monitoring_system.health_model
+    health_model.predict_disease = timed(health_model.predict_disease, stages['predict_disease'])
+    data_handler.write_data_entry = timed(data_handler.write_data_entry, stages['write_data_entry'])
+    run_cycle = timed(monitoring_system.run_cycle, stages['cycle'])
+
+    try:
+        for _ in range(cycles):
+            run_cycle()
+    finally:
+        monitoring_system.alert_scheduler.close()
+        monitoring_system.sensor_reader.close()
+        camera.release_camera()
+        image_writer.close()
+        data_handler.close()
+
+    return {stage: summarise(durations) for stage, durations in stages.items() if durations}
+
+
+def benchmark_ph(readings=500, noise=2.0) -> dict:
+    # Reading noise and bus lock hold time per reading when bit-banged over GPIO and over hardware SPI,
+    # with the same noisy ADC behind both
+    FakeHardware.GPIO.adc_noise = noise
+    sensors = {'bitbang_single': Ph(samples=1), 'bitbang': Ph(), 'spi': Ph(use_spi=True)}
+    assert isinstance(sensors['spi'].spi, FakeHardware.FakeSpiDev), "Ph(use_spi=True) fell back to bit-banging"
+    sensors['spi'].spi.noise = noise
+
+    results = {}
+    try:
+        for name, ph in sensors.items():
+            values, durations = [], []
+            for _ in range(readings):
+                start = time.perf_counter()
+                adc_value = ph.read_channels([ph.channel])[ph.channel]
+                durations.append(time.perf_counter() - start)
+                values.append(ph.voltage_to_ph(ph.adc_to_voltage(adc_value)))
+            results[name] = {'samples': ph.samples, 'ph_stdev': float(np.std(values)),
+                             'bus_hold': summarise(durations)}
+    finally:
+        FakeHardware.GPIO.adc_noise = 0.0
+        for ph in sensors.values():
+            ph.close()
+
+    assert results['spi']['ph_stdev'] < results['bitbang_single']['ph_stdev'], "SPI burst no less noisy"
+    assert results['bitbang']['ph_stdev'] < results['bitbang_single']['ph_stdev'], "bit-bang burst no less noisy"
+    return results
+
+
+def benchmark_detector(min_seconds) -> dict:
+    detector = YellowDetector()
+    results = {}
+    for width, height in RESOLUTIONS:
+        frame = FakeHardware.synthetic_leaf(width, height)
+        results[f"{width}x{height}"] = rate(lambda: detector.detect_yellowing(image=frame), min_seconds)
+        results[f"{width}x{height}_mask_reference"] = rate(lambda: mask_yellowing(detector, frame), min_seconds)
+    return results
+
+
+def mask_yellowing(detector, image) -> float:
+    # The original two-mask implementation, kept as the reference for the histogram engine
+    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    yellow_mask = cv2.inRange(hsv_image, detector.lower_yellow, detector.upper_yellow)
+    green_mask = cv2.inRange(hsv_image, detector.lower_green, detector.upper_green)
+    total_pixels = np.count_nonzero(cv2.bitwise_or(green_mask, yellow_mask))
+    if total_pixels == 0:
+        return 0.0
+    return np.count_nonzero(yellow_mask) / total_pixels * 100
+
+
+def benchmark_detector_accuracy(frames=20) -> dict:
+    # Largest difference in yellowing percentage points against the mask implementation at full size,
+    # for frames passed in and images read from disk. Fails when a reduction exceeds DETECTOR_TOLERANCE
+    rng = np.random.default_rng(0)
+    detectors = {reduction: YellowDetector(reduction=reduction) for reduction in DETECTOR_TOLERANCE}
+    differences = {reduction: 0.0 for reduction in detectors}
+    for i in range(frames):
+        frame = FakeHardware.synthetic_leaf(640, 480, yellow_fraction=rng.uniform(0, 0.5))
+        noise = rng.integers(-20, 21, frame.shape)
+        frame = np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        # PNG is lossless, so the file decodes back to exactly this frame
+        path = f"accuracy_{i}.png"
+        cv2.imwrite(path, frame)
+
+        expected = mask_yellowing(detectors[1], frame)
+        for reduction, detector in detectors.items():
+            for result in (detector.detect_yellowing(image=frame), detector.detect_yellowing(path)):
+                differences[reduction] = max(differences[reduction], abs(result - expected))
+        os.remove(path)
+
+    for reduction, difference in differences.items():
+        assert difference <= DETECTOR_TOLERANCE[reduction], \
+            f"reduction {reduction} differs from the masks by {difference:.3f} points, " \
+            f"more than {DETECTOR_TOLERANCE[reduction]}"
+    return {f"reduction_{reduction}": float(difference) for reduction, difference in differences.items()}
+
+
+def benchmark_model(min_seconds, batch_size=10000) -> dict:
+    health_model = HealthModel()
+    compiled_model = HealthModel(compiled=True)
+    rng = np.random.default_rng(0)
+
+    # Yellowing 0 keeps predict_disease off its logging branch
+    entry = {'timestamp': 0, 'temperature': 24.0, 'humidity': 60.0, 'moisture': 1, 'ph': 6.8,
+             'image_name': None, 'yellowing': 0}
+    batch = {
+        'temperature': rng.uniform(5, 40, batch_size),
+        'humidity': rng.uniform(30, 95, batch_size),
+        'moisture': rng.integers(0, 2, batch_size),
+        'ph': rng.uniform(5, 8, batch_size),
+        'yellowing': rng.integers(0, 2, batch_size),
+    }
+    # Every row yellowing, so each disagreement between the grid and the booster would show
+    yellow_batch = dict(batch, yellowing=np.ones(batch_size, dtype=np.int64))
+
+    return {
+        'load_seconds': health_model.load_seconds,
+        'predict_disease_per_s': rate(lambda: health_model.predict_disease(entry), min_seconds),
+        'predict_disease_many_per_s': rate(lambda: health_model.predict_disease_many(batch), min_seconds,
+                                           batch=batch_size),
+        # Includes building the grid the first time, afterwards it is only loaded
+        'grid_seconds': compiled_model.grid_seconds,
+        'grid_exact_fraction': float(np.mean(
+            compiled_model.grid_codes(compiled_model.feature_matrix(batch)) == GRID_EXACT)),
+        # Must be 0, the grid only answers where it agrees with the booster
+        'grid_mismatches': int(np.count_nonzero(
+            compiled_model.predict_disease_many(yellow_batch) != health_model.predict_disease_many(yellow_batch))),
+        'compiled_predict_disease_per_s': rate(lambda: compiled_model.predict_disease(entry), min_seconds),
+        'compiled_predict_disease_many_per_s': rate(lambda: compiled_model.predict_disease_many(batch), min_seconds,
+                                                    batch=batch_size),
+    }
+
+
+def check_query_history(rows=2000, cached=100) -> dict:
+    # History ranges older than the live cache come from the column store and must stay inside the asked range
+    store = ColumnStore(folder='query_check_columns')
+    start = int(datetime(2026, 1, 1).timestamp() * 1000)
+    entries = [{'timestamp': start + i * 10000, 'ph': 6.5, 'temperature': float(i), 'moisture': 1, 'humidity': 60.0,
+                'yellowing': 0} for i in range(rows)]
+    store.append_rows(entries[:rows - cached])
+    live_cache = LiveCache(history_size=cached, column_store=store)
+    for entry in entries[rows - cached:]:
+        live_cache.update(entry)
+
+    # Entirely older than the cache, raw and downsampled
+    first, last = start + 100 * 10000, start + 199 * 10000
+    raw = live_cache.get_history(first, last)
+    assert [row['timestamp'] for row in raw] == [entry['timestamp'] for entry in entries[100:200]], "raw old range"
+    downsampled = live_cache.get_history(first, last, points=10)
+    assert sum(row['count'] for row in downsampled) == 100, "downsampled old range"
+    assert all(first <= row['timestamp'] <= last for row in downsampled), "bucket outside old range"
+    assert abs(downsampled[-1]['temperature'] - 194.5) < 1e-9, "last bucket average"
+
+    # Spanning the column store and the cache
+    spanning = live_cache.get_history(start + (rows - cached - 50) * 10000, None)
+    assert len(spanning) == cached + 50, "range across store and cache"
+    return {'old_range_rows': len(raw), 'spanning_rows': len(spanning)}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the monitoring pipeline on fake hardware")
+    parser.add_argument('--cycles', type=int, default=200, help="monitoring cycles to time")
+    parser.add_argument('--min-seconds', type=float, default=2.0, help="minimum duration of each micro-benchmark")
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    results = {
+        'created': datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+
+    # Run in a scratch directory so images and data files don't end up in the repo
+    workdir = tempfile.mkdtemp(prefix='benchmark_')
+    cwd = os.getcwd()
+    try:
+        for name in MODEL_FILES:
+            if os.path.exists(os.path.join(REPO_DIR, name)):
+                shutil.copy(os.path.join(REPO_DIR, name), workdir)
+        os.chdir(workdir)
+
+        # Keep the pipeline's logging off the console while timing
+        logging.disable(logging.WARNING)
+        results['cycle'] = benchmark_cycle(args.cycles)
+        # The pipeline's own stage spans, recorded during the cycles above
+        results['cycle_spans'] = metrics.snapshot()['histograms']
+        results['ph'] = benchmark_ph()
+        results['detector_images_per_s'] = benchmark_detector(args.min_seconds)
+        results['detector_max_difference'] = benchmark_detector_accuracy()
+        results['model'] = benchmark_model(args.min_seconds)
+        results['query_history'] = check_query_history()
+    finally:
+        logging.disable(logging.NOTSET)
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f"Results saved to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,43 @@
 import cv2
-from datetime import datetime
-import os
-import shutil
-
-import cv2
+import logging
 import os
 import shutil
 from datetime import datetime
 import time
 
+from ImageLifecycle import shard_folder
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
 
 class Camera:
-    def __init__(self):
+    def __init__(self, image_writer=None, camera_index=0, drain_frames=4, warmup_timeout=5.0, reopen_attempts=3,
+                 name_suffix=''):
         self.unprocessed_images_folder = "unprocessed_images"
         self.processed_images_folder = "processed_images"
 
-        # Initialize the webcam (attempt to use the default camera)
-        self.camera = cv2.VideoCapture(0)
+        # Optional background writer, keeps JPEG encoding off the capture path
+        self.image_writer = image_writer
 
-        # Add delay to allow the camera to initialize
-        time.sleep(2)
+        self.camera_index = camera_index
+        # Appended to photo filenames so cameras sharing the image folders never overwrite each other
+        self.name_suffix = name_suffix
+        # Number of buffered frames thrown away before each shot so the photo is current
+        self.drain_frames = drain_frames
+        # Upper bound on the time spent waiting for the sensor to settle
+        self.warmup_timeout = warmup_timeout
+        # How many times to try re-opening the device after a read failure
+        self.reopen_attempts = reopen_attempts
+
+        self.camera = None
 
         # Ensure the folders exist
         self.setup()
 
-        # Check if the camera is opened successfully
-        if not self.camera.isOpened():
-            print("cannot access camera")
-            exit()
+        # Open the device once and keep it open between photos
+        if not self.open():
+            raise RuntimeError("cannot access camera")
 
     def setup(self) -> None:
         if not os.path.exists(self.unprocessed_images_folder):
@@ -36,34 +46,103 @@ class Camera:
         if not os.path.exists(self.processed_images_folder):
             os.makedirs(self.processed_images_folder)
 
-    def take_photo(self) -> str:
-        # Read a single frame
-        ret, frame = self.camera.read()
-        if not ret:
-            print("failed to grab frame")
-            self.camera.release()
-            exit()
+    def open(self) -> bool:
+        self.release_camera()
+
+        # Initialize the webcam
+        self.camera = cv2.VideoCapture(self.camera_index)
+
+        # Check if the camera is opened successfully
+        if not self.camera.isOpened():
+            logger.error("cannot access camera %s", self.camera_index)
+            return False
+
+        # Keep the driver buffer small so drained frames are cheap
+        self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        self.wait_until_ready()
+        return True
+
+    def wait_until_ready(self, min_brightness=10.0, tolerance=2.0, stable_frames=3, retry_delay=0.05) -> bool:
+        # Instead of a fixed sleep, read frames until exposure has settled:
+        # the image is not black and mean brightness stops changing between frames
+        deadline = time.monotonic() + self.warmup_timeout
+        previous = None
+        stable = 0
+
+        while time.monotonic() < deadline:
+            ret, frame = self.camera.read()
+            if not ret:
+                # No frame yet, back off instead of spinning a core until the camera wakes up
+                time.sleep(retry_delay)
+                continue
+
+            brightness = float(cv2.mean(frame)[0])
+            if previous is not None and brightness >= min_brightness and abs(brightness - previous) <= tolerance:
+                stable += 1
+                if stable >= stable_frames:
+                    return True
+            else:
+                stable = 0
+            previous = brightness
+
+        logger.warning("camera did not settle before warm-up timeout")
+        return False
+
+    def drain(self) -> None:
+        # Discard frames that were buffered while the camera sat idle
+        for _ in range(self.drain_frames):
+            if not self.camera.grab():
+                break
+
+    def read_frame(self):
+        for attempt in range(self.reopen_attempts + 1):
+            # Only reopen the device after a failed read
+            if attempt > 0:
+                logger.warning("failed to grab frame, reopening camera")
+                self.open()
+
+            if self.camera is not None and self.camera.isOpened():
+                self.drain()
+                ret, frame = self.camera.read()
+                if ret:
+                    return frame
+
+        raise RuntimeError("failed to grab frame")
+
+    def take_photo(self, return_frame=False):
+        # Read a single, current frame
+        frame = self.read_frame()
 
         # Generate a timestamped filename
-        filename = datetime.now().strftime("%Y%m%d_%H%M%S.jpg")
+        filename = datetime.now().strftime("%Y%m%d_%H%M%S") + f"{self.name_suffix}.jpg"
         filename = f"{self.unprocessed_images_folder}/{filename}"
 
         # Save the captured image
-        cv2.imwrite(filename, frame)
-        print(f"image saved as {filename}")
+        if self.image_writer is not None:
+            self.image_writer.write(filename, frame)
+        else:
+            with metrics.span('encode'):
+                cv2.imwrite(filename, frame)
+            logger.debug("image saved as %s", filename)
+
+        if return_frame:
+            return filename, frame
 
         return filename
 
     def move_processed_image(self, filename: str) -> None:
         src_path = os.path.join(self.unprocessed_images_folder, filename)
-        dest_path = os.path.join(self.processed_images_folder, filename)
 
         if os.path.exists(src_path):
-            shutil.move(src_path, dest_path)
+            # Same date-sharded layout the ImageLifecycle manager uses
+            dest_folder = shard_folder(self.processed_images_folder, filename, os.path.getmtime(src_path))
+            os.makedirs(dest_folder, exist_ok=True)
+            shutil.move(src_path, os.path.join(dest_folder, filename))
         else:
-            print(f"{filename} does not exist")
+            logger.warning("%s does not exist", filename)
 
     def release_camera(self):
-        if self.camera.isOpened():
+        if self.camera is not None and self.camera.isOpened():
             self.camera.release()
-            print("Camera released.")
+            logger.info("Camera released.")
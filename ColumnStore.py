@@ -0,0 +1,229 @@
+import argparse
+import csv
+import json
+import logging
+import os
+from datetime import datetime
+
+import numpy as np
+
+from DataHandler import DataHandler
+
+logger = logging.getLogger(__name__)
+
+# Column name -> on-disk dtype, one raw little-endian file per column
+COLUMNS = {
+    'timestamp': np.dtype('<i8'),
+    'ph': np.dtype('<f4'),
+    'temperature': np.dtype('<f4'),
+    'soil_moisture': np.dtype('i1'),
+    'humidity': np.dtype('<f4'),
+    'yellowing': np.dtype('i1'),
+    'station': np.dtype('<i2'),
+}
+
+# Data entry keys that are stored under a different column name
+ENTRY_KEYS = {'soil_moisture': 'moisture'}
+
+# Stored in place of a missing reading for integer columns, floats use NaN
+MISSING_INT = -1
+
+# Stations are stored as small integer codes, the names are kept in this file in the store's folder
+STATIONS_FILE = 'stations.json'
+
+
+class ColumnStore:
+    def __init__(self, folder='data/columns'):
+        self.folder = folder
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        # Station name -> code, codes are never reused
+        self.stations_path = os.path.join(self.folder, STATIONS_FILE)
+        self.stations = {}
+        if os.path.exists(self.stations_path):
+            with open(self.stations_path) as file:
+                self.stations = json.load(file)
+
+    def station_code(self, name, create=False):
+        # MISSING_INT for rows without a station, None for a name that was never stored
+        if name is None or name == '':
+            return MISSING_INT
+        if name not in self.stations and create:
+            self.stations[name] = len(self.stations)
+            temporary = self.stations_path + '.tmp'
+            with open(temporary, 'w') as file:
+                json.dump(self.stations, file)
+            os.replace(temporary, self.stations_path)
+        return self.stations.get(name)
+
+    def station_names(self) -> dict:
+        # Code -> station name, for decoding a loaded station column
+        return {code: name for name, code in self.stations.items()}
+
+    @staticmethod
+    def _day_key(timestamp_ms) -> str:
+        return datetime.fromtimestamp(timestamp_ms / 1000).strftime("%Y%m%d")
+
+    def _column_path(self, day, column) -> str:
+        return os.path.join(self.folder, day, f"{column}.bin")
+
+    @staticmethod
+    def _to_array(values, dtype):
+        # Values may be numbers or CSV strings, None and empty strings are missing readings
+        if dtype.kind == 'f':
+            converted = [np.nan if value is None or value == '' else float(value) for value in values]
+        else:
+            converted = [MISSING_INT if value is None or value == '' else int(float(value)) for value in values]
+        return np.array(converted, dtype=dtype)
+
+    def append_rows(self, entries) -> None:
+        # Group rows by day so each partition is appended with one write per column
+        days = {}
+        for entry in entries:
+            days.setdefault(self._day_key(int(entry['timestamp'])), []).append(entry)
+
+        for day, rows in days.items():
+            os.makedirs(os.path.join(self.folder, day), exist_ok=True)
+            self._pad_station(day)
+            for column, dtype in COLUMNS.items():
+                if column == 'station':
+                    values = np.array([self.station_code(row.get('station'), create=True) for row in rows], dtype=dtype)
+                else:
+                    key = ENTRY_KEYS.get(column, column)
+                    values = self._to_array([row[key] for row in rows], dtype)
+                with open(self._column_path(day, column), 'ab') as file:
+                    values.tofile(file)
+
+    def _rows_on_disk(self, day, column) -> int:
+        path = self._column_path(day, column)
+        return os.path.getsize(path) // COLUMNS[column].itemsize if os.path.exists(path) else 0
+
+    def _pad_station(self, day) -> None:
+        # Partitions written before the station column existed get missing stations for their old rows,
+        # so new rows line up with the other columns
+        missing = self._rows_on_disk(day, 'timestamp') - self._rows_on_disk(day, 'station')
+        if missing > 0:
+            with open(self._column_path(day, 'station'), 'ab') as file:
+                np.full(missing, MISSING_INT, dtype=COLUMNS['station']).tofile(file)
+
+    def _last_timestamp(self, day):
+        timestamps = self._open_partition(day, ['timestamp'])['timestamp']
+        return int(timestamps[-1]) if len(timestamps) else None
+
+    def partitions(self) -> list:
+        return sorted(day for day in os.listdir(self.folder) if os.path.isdir(os.path.join(self.folder, day)))
+
+    def _open_partition(self, day, columns) -> dict:
+        # Columns can differ in length after an interrupted append, only rows present in all of them count.
+        # A partition from before the station column existed has no station file and is read as missing stations
+        rows = min(self._rows_on_disk(day, column) for column in COLUMNS
+                   if column != 'station' or os.path.exists(self._column_path(day, column)))
+
+        if rows == 0:
+            return {column: np.empty(0, dtype=COLUMNS[column]) for column in columns}
+
+        partition = {}
+        for column in columns:
+            if column == 'station' and not os.path.exists(self._column_path(day, column)):
+                partition[column] = np.full(rows, MISSING_INT, dtype=COLUMNS[column])
+            else:
+                partition[column] = np.memmap(self._column_path(day, column), dtype=COLUMNS[column], mode='r',
+                                              shape=(rows,))
+        return partition
+
+    def load(self, start_ms=None, end_ms=None, columns=None, station=None) -> dict:
+        # Returns column -> array for rows with start_ms <= timestamp <= end_ms, only one station's rows if given
+        columns = list(columns or COLUMNS)
+        for column in columns:
+            if column not in COLUMNS:
+                raise ValueError(f"Unknown column: {column}")
+        wanted = columns if 'timestamp' in columns else columns + ['timestamp']
+        if station is not None:
+            code = self.station_code(station)
+            if code is None:
+                return {column: np.empty(0, dtype=COLUMNS[column]) for column in columns}
+            if 'station' not in wanted:
+                wanted = wanted + ['station']
+
+        first_day = self._day_key(start_ms) if start_ms is not None else None
+        last_day = self._day_key(end_ms) if end_ms is not None else None
+
+        parts = []
+        for day in self.partitions():
+            if (first_day is not None and day < first_day) or (last_day is not None and day > last_day):
+                continue
+
+            partition = self._open_partition(day, wanted)
+            timestamps = partition['timestamp']
+
+            # Rows within a partition are in time order, so the range is found by binary search
+            lo = np.searchsorted(timestamps, start_ms, side='left') if start_ms is not None else 0
+            hi = np.searchsorted(timestamps, end_ms, side='right') if end_ms is not None else len(timestamps)
+            if hi > lo:
+                if station is None:
+                    parts.append({column: partition[column][lo:hi] for column in columns})
+                else:
+                    keep = partition['station'][lo:hi] == code
+                    parts.append({column: partition[column][lo:hi][keep] for column in columns})
+
+        if not parts:
+            return {column: np.empty(0, dtype=COLUMNS[column]) for column in columns}
+        if len(parts) == 1:
+            # Still memory mapped, nothing is read until it is used
+            return parts[0]
+        return {column: np.concatenate([part[column] for part in parts]) for column in columns}
+
+    def import_csv(self, paths, chunk_rows=10000) -> int:
+        # Convert recorded CSV history, chunk by chunk so large files never sit in memory.
+        # load() needs every partition in time order, so rows at or before a partition's last stored
+        # timestamp are skipped. Importing the same files twice adds nothing
+        count = 0
+        skipped = 0
+        last_timestamps = {}
+        for path in paths:
+            # Headerless legacy files are read with the original columns
+            header, has_header = DataHandler.read_header(path)
+            with open(path, newline='') as file:
+                chunk = []
+                for row in csv.DictReader(file, fieldnames=None if has_header else header):
+                    timestamp = int(row['timestamp'])
+                    day = self._day_key(timestamp)
+                    if day not in last_timestamps:
+                        last_timestamps[day] = self._last_timestamp(day)
+                    if last_timestamps[day] is not None and timestamp <= last_timestamps[day]:
+                        skipped += 1
+                        continue
+                    last_timestamps[day] = timestamp
+
+                    row['moisture'] = row.pop('soil_moisture')
+                    chunk.append(row)
+                    if len(chunk) >= chunk_rows:
+                        self.append_rows(chunk)
+                        count += len(chunk)
+                        chunk = []
+                if chunk:
+                    self.append_rows(chunk)
+                    count += len(chunk)
+            logger.info("Imported %s", path)
+        if skipped:
+            logger.info("Skipped %d rows already stored or out of time order", skipped)
+        return count
+
+    def close(self) -> None:
+        # Every append is written straight through, nothing to flush
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert recorded CSV history to the column store")
+    parser.add_argument('--columns-folder', default='data/columns')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    data_handler = DataHandler(read_only=True)
+
+    store = ColumnStore(folder=args.columns_folder)
+    imported = store.import_csv(data_handler.data_files())
+    print(f"Imported {imported} rows into {args.columns_folder}")
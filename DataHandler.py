@@ -1,63 +1,460 @@
 from datetime import datetime
 import os
+import io
+import logging
+import re
 import csv
+import time
+import threading
+import bisect
+
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# What gets fsync'd: nothing, every flush, or only on close
+FSYNC_NEVER = 'never'
+FSYNC_ON_FLUSH = 'flush'
+FSYNC_ON_CLOSE = 'close'
 
 
 class DataHandler:
-    def __init__(self):
-        self.data_folder = 'data'
+    header = ['timestamp', 'ph', 'temperature', 'soil_moisture', 'humidity', 'yellowing', 'image_filepath']
+
+    def __init__(self, flush_rows=1, flush_bytes=64 * 1024, flush_interval=None, fsync=FSYNC_NEVER,
+                 rotate_daily=False, max_file_bytes=None, backends=None, index_bytes=64 * 1024, data_folder='data',
+                 include_station=False, read_only=False):
+        self.data_folder = data_folder
         self.data_file_name = 'timeseries_data.csv'
 
-        self.setup()
+        # Buffered rows are written once any of these limits is reached
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        # Start a new file every day and/or once a file reaches this size
+        self.rotate_daily = rotate_daily
+        self.max_file_bytes = max_file_bytes
+
+        # A timestamp -> byte offset index point is kept roughly every index_bytes of a data file
+        self.index_bytes = index_bytes
+        # data file path -> ([timestamps], [offsets]), loaded lazily
+        self.indexes = {}
+        # Files where the clock stepped back between rows, queries read these in full
+        self.unordered = set()
+        # data file path -> timestamp of its last row, to notice such a step when appending
+        self.last_timestamps = {}
+
+        # Several stations writing to one file need a column saying which one each row came from
+        self.include_station = include_station
+        if include_station:
+            self.header = self.header + ['station']
+
+        # Extra storage backends (e.g. ColumnStore) that receive every flushed group of rows
+        self.backends = list(backends or [])
+
+        line = io.StringIO()
+        csv.writer(line).writerow(self.header)
+        self.header_line = line.getvalue()
+
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_entries = []
+        self.buffer_bytes = 0
+        self.last_flush = time.monotonic()
+
+        self.file = None
+        self.file_path = None
+        self.file_day = None
+        self.file_part = 0
+
+        # Readers (replay, import, training) only use data_files() and query(). Nothing is created,
+        # opened for appending, indexed to disk or flushed in the background, so they never touch the live files
+        self.read_only = read_only
+        if not read_only:
+            self.setup()
+
+        # Writes only check flush_interval when a row arrives, so a stalled sensor loop would leave
+        # buffered rows unwritten. A background timer flushes them once they are due
+        self.stop_event = threading.Event()
+        self.flusher = None
+        if flush_interval is not None and not read_only:
+            self.flusher = threading.Thread(target=self._flush_periodically, name="DataFlusher", daemon=True)
+            self.flusher.start()
 
     def setup(self) -> None:
         # create data dir
         if not os.path.exists(self.data_folder):
             os.makedirs(self.data_folder)
 
+        # Open the newest existing part for today, or create the file with headers
+        day = self._day_key(time.time() * 1000)
+        self._open_file(day, self._latest_part(day))
+
+    def _day_key(self, timestamp_ms):
+        if not self.rotate_daily:
+            return None
+        return datetime.fromtimestamp(timestamp_ms / 1000).strftime("%Y%m%d")
+
+    def _file_path_for(self, day, part) -> str:
+        base, ext = os.path.splitext(self.data_file_name)
+        name = base
+        if day is not None:
+            name += f"_{day}"
+        if part:
+            name += f"_{part}"
+        return os.path.join(self.data_folder, name + ext)
+
+    def _parse_file_name(self, filename):
+        # Returns (day, part) for a data file name, or None for unrelated files
+        base, ext = os.path.splitext(self.data_file_name)
+        match = re.fullmatch(rf"{re.escape(base)}(?:_(\d{{8}}))?(?:_(\d+))?{re.escape(ext)}", filename)
+        if match is None:
+            return None
+        return match.group(1), int(match.group(2) or 0)
+
+    def _latest_part(self, day) -> int:
+        parts = [
+            parsed[1] for parsed in map(self._parse_file_name, os.listdir(self.data_folder))
+            if parsed is not None and parsed[0] == day
+        ]
+        return max(parts, default=0)
+
+    def data_files(self) -> list:
+        # Every data file, including rotated ones, oldest first
+        if not os.path.isdir(self.data_folder):
+            return []
+        files = []
+        for filename in os.listdir(self.data_folder):
+            parsed = self._parse_file_name(filename)
+            if parsed is not None:
+                files.append((parsed[0] or '', parsed[1], os.path.join(self.data_folder, filename)))
+        return [path for _, _, path in sorted(files)]
+
+    def _open_file(self, day, part) -> None:
+        self._close_file()
+
+        self.file_day = day
+        self.file_part = part
+        self.file_path = self._file_path_for(day, part)
+
         # check if file exists, if not, create it
-        if not os.path.exists(self.data_file_name):
+        exists = os.path.exists(self.file_path) and os.path.getsize(self.file_path) > 0
+        if exists and self.read_header(self.file_path)[0] != self.header:
+            # Written with other columns (e.g. before the station column was enabled), continue in a new part
+            logger.warning("%s has different columns, starting a new file.", self.file_path)
+            self._open_file(day, part + 1)
+            return
+
+        self.file = open(self.file_path, mode='a', newline='')
+        if not exists:
             # create the file and write headers
-            with open(self.data_file_name, mode='w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow(
-                    ['timestamp', 'ph', 'temperature', 'soil_moisture', 'humidity', 'yellowing', 'image_filepath'])
-            print(f"{self.data_file_name} created.")
+            self.file.write(self.header_line)
+            self.file.flush()
+            logger.info("%s created.", self.file_path)
         else:
-            print(f"{self.data_file_name} already exists.")
+            logger.info("%s already exists.", self.file_path)
+
+        # Appends extend this file's index, so it must be loaded first
+        self._get_index(self.file_path)
+
+    @classmethod
+    def read_header(cls, path):
+        # Returns (columns, has_header). The first version wrote its header to the working directory
+        # instead of the data folder, so those files start straight with rows in the original columns
+        with open(path, newline='') as file:
+            row = next(csv.reader(file), [])
+        if row and row[0].isdigit():
+            return list(cls.header), False
+        return row, True
+
+    def _close_file(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
 
     @staticmethod
-    def create_data_entry(temperature, moisture, humidity, ph, image_name, yellowing) -> dict:
-        # Get current datetime
-        now = datetime.now()
+    def create_data_entry(temperature, moisture, humidity, ph, image_name, yellowing, timestamp=None,
+                          station=None) -> dict:
+        if timestamp is None:
+            # Get current datetime
+            now = datetime.now()
 
-        # Get current time in milliseconds
-        milliseconds = int(now.timestamp() * 1000)
-        data = {'timestamp': milliseconds,
+            # Get current time in milliseconds
+            timestamp = int(now.timestamp() * 1000)
+
+        data = {'timestamp': timestamp,
                 'temperature': temperature,
                 'humidity': humidity,
                 'moisture': moisture,
                 'ph': ph,
                 'image_name': image_name,
-                'yellowing': yellowing
+                'yellowing': yellowing,
+                'station': station
                 }
 
         return data
 
-    def write_data_entry(self, data: dict) -> None:
+    @staticmethod
+    def format_row(data: dict, include_station=False) -> str:
         timestamp = data['timestamp']
-        ph =data['ph']
+        ph = data['ph']
         temperature = data['temperature']
         soil_moisture = data['moisture']
         humidity = data['humidity']
         image_name = data['image_name']
         yellowing = data['yellowing']
 
-        # append csv
-        with open(f"{self.data_folder}/{self.data_file_name}", mode='a', newline='') as file:
-            writer = csv.writer(file)
-            # write the data as a new row
-            writer.writerow([
-                timestamp, ph, temperature, soil_moisture, humidity, yellowing, image_name
-            ])
-        print(f"data written for timestamp {timestamp}")
+        row = [timestamp, ph, temperature, soil_moisture, humidity, yellowing, image_name]
+        if include_station:
+            row.append(data.get('station'))
+
+        line = io.StringIO()
+        csv.writer(line).writerow(row)
+        return line.getvalue()
+
+    def write_data_entry(self, data: dict) -> None:
+        if self.read_only:
+            raise ValueError("DataHandler was opened read-only")
+        line = self.format_row(data, self.include_station)
+
+        with self.lock:
+            # Rows always go to the file for their own day
+            day = self._day_key(data['timestamp'])
+            if day != self.file_day:
+                self._flush()
+                self._open_file(day, self._latest_part(day))
+
+            # Start a new part when this row would take the file over its size limit
+            if self.max_file_bytes is not None:
+                size = self.file.tell() + self.buffer_bytes + len(line)
+                has_rows = self.file.tell() + self.buffer_bytes > len(self.header_line)
+                if size > self.max_file_bytes and has_rows:
+                    self._flush()
+                    self._open_file(self.file_day, self.file_part + 1)
+
+            self.buffer.append(line)
+            self.buffer_entries.append(data)
+            self.buffer_bytes += len(line)
+
+            if (len(self.buffer) >= self.flush_rows or self.buffer_bytes >= self.flush_bytes or
+                    (self.flush_interval is not None and time.monotonic() - self.last_flush >= self.flush_interval)):
+                self._flush()
+
+        logger.debug("data written for timestamp %s", data['timestamp'])
+
+    def _flush(self) -> None:
+        if self.buffer:
+            with metrics.span('flush'):
+                self._index_buffer()
+
+                # One write for the whole group of rows
+                self.file.write(''.join(self.buffer))
+                self.file.flush()
+                if self.fsync == FSYNC_ON_FLUSH:
+                    os.fsync(self.file.fileno())
+
+                # The rows are in the CSV now. A failed write above leaves them buffered for the next flush,
+                # a failing backend below must not get them written twice
+                entries = self.buffer_entries
+                self.buffer = []
+                self.buffer_entries = []
+                self.buffer_bytes = 0
+
+                for backend in self.backends:
+                    try:
+                        backend.append_rows(entries)
+                    except Exception:
+                        # Retrying could duplicate whatever the backend wrote before failing, the CSV keeps the rows
+                        logger.exception("%s dropped %d rows", type(backend).__name__, len(entries))
+                        metrics.increment('backend_errors_total', backend=type(backend).__name__)
+        self.last_flush = time.monotonic()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush_periodically(self) -> None:
+        while not self.stop_event.wait(self.flush_interval):
+            try:
+                with self.lock:
+                    if self.buffer and time.monotonic() - self.last_flush >= self.flush_interval:
+                        self._flush()
+            except OSError as e:
+                logger.warning("Periodic flush failed, rows stay buffered: %s", e)
+
+    def _index_path(self, path) -> str:
+        return path + '.idx'
+
+    def _index_buffer(self) -> None:
+        # Extend the current file's index with the rows about to be written
+        timestamps, offsets = self._get_index(self.file_path)
+        last_timestamp = self._last_timestamp(self.file_path)
+        offset = self.file.tell()
+        new_points = []
+        for line, entry in zip(self.buffer, self.buffer_entries):
+            timestamp = int(entry['timestamp'])
+            if last_timestamp is not None and timestamp < last_timestamp and self.file_path not in self.unordered:
+                # The clock stepped back (e.g. an NTP correction), the index point records it
+                self.unordered.add(self.file_path)
+                timestamps.append(timestamp)
+                offsets.append(offset)
+                new_points.append(f"{timestamp},{offset},unordered\n")
+            elif not offsets or offset - offsets[-1] >= self.index_bytes:
+                timestamps.append(timestamp)
+                offsets.append(offset)
+                new_points.append(f"{timestamp},{offset}\n")
+            last_timestamp = timestamp
+            offset += len(line.encode())
+        self.last_timestamps[self.file_path] = last_timestamp
+
+        if new_points:
+            with open(self._index_path(self.file_path), mode='a') as file:
+                file.write(''.join(new_points))
+
+    def _get_index(self, path):
+        if path in self.indexes:
+            return self.indexes[path]
+
+        timestamps, offsets = [], []
+        index_path = self._index_path(path)
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                for line in file:
+                    fields = line.rstrip('\n').split(',')
+                    timestamps.append(int(fields[0]))
+                    offsets.append(int(fields[1]))
+                    if len(fields) > 2:
+                        self.unordered.add(path)
+        elif os.path.exists(path):
+            # Files written before the index existed are scanned once and their index saved
+            timestamps, offsets = self._build_index(path)
+
+        self.indexes[path] = (timestamps, offsets)
+        return timestamps, offsets
+
+    def _build_index(self, path):
+        timestamps, offsets, points = [], [], []
+        last_timestamp = None
+        with open(path, mode='rb') as file:
+            if self.read_header(path)[1]:
+                file.readline()
+            offset = file.tell()
+            for line in iter(file.readline, b''):
+                timestamp = int(line.split(b',', 1)[0])
+                if last_timestamp is not None and timestamp < last_timestamp and path not in self.unordered:
+                    self.unordered.add(path)
+                    timestamps.append(timestamp)
+                    offsets.append(offset)
+                    points.append(f"{timestamp},{offset},unordered\n")
+                elif not offsets or offset - offsets[-1] >= self.index_bytes:
+                    timestamps.append(timestamp)
+                    offsets.append(offset)
+                    points.append(f"{timestamp},{offset}\n")
+                last_timestamp = timestamp
+                offset += len(line)
+
+        if not self.read_only:
+            with open(self._index_path(path), mode='w') as file:
+                file.writelines(points)
+        self.last_timestamps[path] = last_timestamp
+        return timestamps, offsets
+
+    def _last_timestamp(self, path):
+        # Only the rows after the last index point need reading to find the last one
+        if path not in self.last_timestamps:
+            timestamps, offsets = self._get_index(path)
+            last_timestamp = None
+            if offsets:
+                with open(path, mode='rb') as file:
+                    file.seek(offsets[-1])
+                    for line in iter(file.readline, b''):
+                        last_timestamp = int(line.split(b',', 1)[0])
+            self.last_timestamps[path] = last_timestamp
+        return self.last_timestamps[path]
+
+    @staticmethod
+    def _parse_value(column, value):
+        if column in ('image_filepath', 'station'):
+            return value
+        if value == '':
+            return None
+        if column == 'timestamp':
+            return int(value)
+        return float(value)
+
+    def query(self, start_ms=None, end_ms=None, columns=None):
+        # Yields rows with start_ms <= timestamp <= end_ms as dicts of the requested CSV columns, in file order.
+        # The index assumes rows are written in time order, true unless the clock steps back (e.g. NTP
+        # correcting a Pi that booted without network). Files where that happened are read in full instead
+        columns = list(columns or self.header)
+        for column in columns:
+            if column not in self.header:
+                raise ValueError(f"Unknown column: {column}")
+
+        # Buffered rows become part of the files before reading
+        self.flush()
+
+        with self.lock:
+            files = self.data_files()
+            indexes = [self._get_index(path) for path in files]
+            unordered = set(self.unordered)
+
+        for path, (timestamps, offsets) in zip(files, indexes):
+            ordered = path not in unordered
+            # Nothing to read in a file starting after the range. Files before it are cheap,
+            # the seek below lands on their last index point
+            if ordered and end_ms is not None and timestamps and timestamps[0] > end_ms:
+                continue
+
+            yield from self._query_file(path, timestamps, offsets, start_ms, end_ms, columns, ordered)
+
+    def _query_file(self, path, timestamps, offsets, start_ms, end_ms, columns, ordered=True):
+        # Older files may lack newer columns (e.g. station), those read as None
+        header, has_header = self.read_header(path)
+        positions = [header.index(column) if column in header else None for column in columns]
+
+        with open(path, mode='rb') as file:
+            # Seek to the last index point before the range instead of reading from the top
+            point = bisect.bisect_left(timestamps, start_ms) - 1 if ordered and start_ms is not None else -1
+            if point >= 0:
+                file.seek(offsets[point])
+            elif has_header:
+                file.readline()
+
+            for line in iter(file.readline, b''):
+                row = next(csv.reader([line.decode()]))
+                if not row:
+                    continue
+
+                timestamp = int(row[0])
+                if start_ms is not None and timestamp < start_ms:
+                    continue
+                if end_ms is not None and timestamp > end_ms:
+                    if ordered:
+                        return
+                    continue
+
+                yield {column: None if position is None else self._parse_value(column, row[position])
+                       for column, position in zip(columns, positions)}
+
+    def close(self) -> None:
+        # Buffered rows are never lost on a clean shutdown
+        self.stop_event.set()
+        if self.flusher is not None and self.flusher.is_alive():
+            self.flusher.join()
+        with self.lock:
+            self._flush()
+            self._close_file()
+            for backend in self.backends:
+                backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
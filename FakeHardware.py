@@ -0,0 +1,201 @@
+import sys
+import time
+import types
+
+import numpy as np
+
+
+def synthetic_leaf(width=640, height=480, yellow_fraction=0.1):
+    # BGR frame of a green leaf with a yellow patch covering yellow_fraction of it
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[:, :] = (40, 160, 60)  # green
+    patch_width = int(width * yellow_fraction)
+    frame[:, :patch_width] = (40, 200, 220)  # yellow
+    return frame
+
+
+class FakeGPIO(types.ModuleType):
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        super().__init__('RPi.GPIO')
+        self.mode = None
+        self.directions = {}
+        self.levels = {}
+        self.callbacks = {}
+
+        # MCP3008 emulation for the bit-banged pH reads: channel -> 10-bit value
+        self.adc_values = {0: 1015}
+        self.adc_pins = {'clk': 17, 'miso': 27, 'mosi': 22, 'cs': 26}
+        self.adc_clocks = 0
+        self.adc_command = 0
+        # Standard deviation in ADC counts added to every conversion, like FakeSpiDev's noise
+        self.adc_noise = 0.0
+        self.adc_rng = np.random.default_rng(0)
+        self.adc_value = None
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        self.directions[pin] = direction
+        self.levels.setdefault(pin, initial if initial is not None else self.LOW)
+
+    def output(self, pin, value):
+        value = self.HIGH if value else self.LOW
+        previous = self.levels.get(pin, self.LOW)
+        self.levels[pin] = value
+
+        if pin == self.adc_pins['cs'] and value == self.LOW:
+            # Chip selected, a new conversion starts
+            self.adc_clocks = 0
+            self.adc_command = 0
+            self.adc_value = None
+        elif pin == self.adc_pins['clk'] and value == self.HIGH and previous == self.LOW:
+            if self.levels.get(self.adc_pins['cs']) == self.LOW:
+                self.adc_clocks += 1
+                if self.adc_clocks <= 5:
+                    # Start bit, single-ended bit and three channel bits are clocked in from MOSI
+                    self.adc_command = (self.adc_command << 1) | self.levels.get(self.adc_pins['mosi'], 0)
+
+    def input(self, pin):
+        if pin == self.adc_pins['miso']:
+            return self._adc_bit()
+        return self.levels.get(pin, self.LOW)
+
+    def _adc_bit(self):
+        # Read i after the command: a null bit, ten data bits MSB first, then a trailing bit
+        read = self.adc_clocks - 6
+        if read < 1 or read > 10:
+            return self.LOW
+        if self.adc_value is None:
+            # Converted once per read, every data bit comes from the same value
+            value = self.adc_values.get(self.adc_command & 0x07, 0)
+            if self.adc_noise:
+                value += self.adc_rng.normal(0, self.adc_noise)
+            self.adc_value = int(min(max(round(value), 0), 1023))
+        return (self.adc_value >> (10 - read)) & 0x1
+
+    def set_input(self, pin, level):
+        # Drive an input pin from a test or benchmark, firing any edge callback
+        previous = self.levels.get(pin, self.LOW)
+        self.levels[pin] = level
+        if pin in self.callbacks and previous != level:
+            edge, callback = self.callbacks[pin]
+            rising = level == self.HIGH
+            if edge == self.BOTH or (edge == self.RISING) == rising:
+                callback(pin)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        self.levels.clear()
+        self.callbacks.clear()
+
+
+class FakeDHT(types.ModuleType):
+    DHT11 = 11
+    DHT22 = 22
+    AM2302 = 22
+
+    def __init__(self):
+        super().__init__('Adafruit_DHT')
+        self.humidity = 60.0
+        self.temperature = 24.0
+        # Seconds each read blocks for, read_retry on real hardware can take several seconds
+        self.delay = 0.0
+
+    def read_retry(self, sensor, pin, retries=15, delay_seconds=2):
+        if self.delay:
+            time.sleep(self.delay)
+        return self.humidity, self.temperature
+
+
+class FakeVideoCapture:
+    # Stands in for cv2.VideoCapture, every read returns a copy of the same synthetic frame
+    frame = synthetic_leaf()
+
+    def __init__(self, index=0):
+        self.index = index
+        self.opened = True
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        return True
+
+    def grab(self):
+        return self.opened
+
+    def read(self):
+        if not self.opened:
+            return False, None
+        return True, self.frame.copy()
+
+    def release(self):
+        self.opened = False
+
+
+class FakeSpiDev:
+    # Stands in for spidev.SpiDev wired to an MCP3008, with optional noise on every conversion
+    def __init__(self, adc_values=None, noise=0.0, seed=0):
+        self.adc_values = adc_values if adc_values is not None else {0: 1015}
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.transfers = 0
+
+    def open(self, bus, device):
+        pass
+
+    def xfer2(self, data):
+        # One conversion per transfer: start bit, single-ended + channel, then the 10-bit result
+        self.transfers += 1
+        channel = (data[1] >> 4) & 0x07
+        value = self.adc_values.get(channel, 0)
+        if self.noise:
+            value += self.rng.normal(0, self.noise)
+        value = int(min(max(round(value), 0), 1023))
+        return [0, (value >> 8) & 0x03, value & 0xff]
+
+    def close(self):
+        pass
+
+
+GPIO = FakeGPIO()
+DHT = FakeDHT()
+
+
+def install(spi=False):
+    # Replace the Raspberry Pi libraries and the webcam, must run before the repo modules are imported
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = GPIO
+    sys.modules['RPi'] = rpi
+    sys.modules['RPi.GPIO'] = GPIO
+    sys.modules['Adafruit_DHT'] = DHT
+
+    if spi:
+        # Makes Ph(use_spi=True) find a kernel SPI device
+        spidev = types.ModuleType('spidev')
+        spidev.SpiDev = FakeSpiDev
+        sys.modules['spidev'] = spidev
+
+    import cv2
+    cv2.VideoCapture = FakeVideoCapture
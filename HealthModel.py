@@ -1,19 +1,89 @@
 import numpy as np
-import pandas as pd
-from random import choices
 from datetime import datetime, timedelta
-from sklearn.model_selection import train_test_split
-from xgboost import XGBClassifier
-from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
-import joblib
+from bisect import bisect_right
+import hashlib
+import json
+import logging
 import os
+import time
+
+# pandas, scikit-learn, joblib and xgboost are imported where they are used,
+# importing this module for inference only pays for numpy
+from RollingWindow import RollingWindow, feature_names
+
+logger = logging.getLogger(__name__)
+
+# Seconds a restarted monitor may spend importing xgboost and loading the model
+STARTUP_BUDGET_SECONDS = 1.0
+
+# Model saved by older versions as a pickled XGBClassifier, converted on first start
+LEGACY_MODEL_FILE = 'plant_health_xgb_model.pkl'
+
+# Model inputs, in the column order the model was trained with
+FEATURES = ['temperature', 'humidity', 'moisture', 'ph']
+
+# Rolling statistics of the inputs, appended after FEATURES when temporal features are enabled
+TEMPORAL_FEATURES = feature_names(FEATURES)
+
+# Optimal conditions (e.g., ranges for healthy plant conditions)
+OPTIMAL_TEMP_RANGE = (20, 30)  # Temperature between 20°C and 30°C
+OPTIMAL_HUMIDITY_RANGE = (50, 80)  # Humidity between 50% and 80%
+OPTIMAL_PH_RANGE = (6.0, 7.5)  # pH between 6.0 and 7.5
+
+# Seconds between rows of the synthetic training data, one per day
+SYNTHETIC_INTERVAL = 86400
+
+# Base temperature per season: Spring, Summer, Fall, Winter
+SEASON_BASE_TEMPS = np.array([15, 25, 20, 10])
+
+# Compiled mode tabulates predictions over this box for both moisture states, readings outside it use the booster
+GRID_AXES = ['temperature', 'humidity', 'ph']
+GRID_BOUNDS = {'temperature': (-10.0, 50.0), 'humidity': (0.0, 100.0), 'ph': (3.0, 10.0)}
+GRID_STEPS = {'temperature': 0.5, 'humidity': 1.0, 'ph': 0.05}
+
+# Grid cell values: never disease, disease if the plant is yellowing, or ask the booster
+GRID_HEALTHY = 0
+GRID_DISEASE_IF_YELLOW = 1
+GRID_EXACT = -1
+
+# Bumped whenever the layout of the cached grid file changes
+GRID_VERSION = 1
 
 
 class HealthModel:
-    def __init__(self, num_records=1000, start_date=None, model_file='plant_health_xgb_model.pkl'):
+    def __init__(self, num_records=1000, start_date=None, model_file=None, seed=None, temporal_features=False,
+                 temporal_window_days=3, compiled=False, grid_steps=None, grid_bounds=None):
         self.num_records = num_records
+        # Seeded generator for the synthetic data, the same seed gives the same training set
+        self.rng = np.random.default_rng(seed)
+
+        # Optionally also look at rolling statistics of the last temporal_window_days, so sustained stress
+        # (e.g. several dry days in a row) counts, not just the current reading
+        self.temporal_features = temporal_features
+        self.temporal_window_days = temporal_window_days
+        self.feature_names = FEATURES + TEMPORAL_FEATURES if temporal_features else list(FEATURES)
+        # Seconds between the rows the temporal window was trained on, read from the model's window file.
+        # Monitoring feeds its window at the same spacing so both sides see the same span and row count
+        self.window_interval = None
+
+        # Native XGBoost format, .json or .ubj, the two feature sets are kept in separate files
+        if model_file is None:
+            model_file = 'plant_health_xgb_model_temporal.ubj' if temporal_features else 'plant_health_xgb_model.ubj'
         self.model_file = model_file
         self.model = None  # Initialize model as None
+        self.booster = None  # Underlying booster, used for fast NumPy predictions
+        self.load_seconds = None  # Time taken to import xgboost and load the booster
+
+        # Compiled mode answers predict_disease from a lookup table over the four inputs,
+        # there are too many temporal features to tabulate
+        if compiled and temporal_features:
+            raise ValueError("compiled mode needs temporal_features=False")
+        self.grid_steps = dict(GRID_STEPS, **(grid_steps or {}))
+        self.grid_bounds = dict(GRID_BOUNDS, **(grid_bounds or {}))
+        self.grid = None  # int8 (moisture, temperature, humidity, ph) table of GRID_* values
+        self.grid_edges = None  # float32 cell edges per GRID_AXES entry
+        self.grid_edge_lists = None
+        self.grid_seconds = None  # Time taken to build or load the grid
 
         # Set start date if not provided
         if not start_date:
@@ -22,13 +92,20 @@ class HealthModel:
 
         # Check if model file exists, if not, generate data and train a new model
         if os.path.exists(self.model_file):
+            if temporal_features:
+                self.load_window()
+            self.setup()
+        elif os.path.exists(LEGACY_MODEL_FILE) and not temporal_features:
+            self.convert_legacy_model(LEGACY_MODEL_FILE)
             self.setup()
         else:
-            print(f"Model file {self.model_file} not found, generating data and training model...")
+            from sklearn.model_selection import train_test_split
+
+            logger.info("Model file %s not found, generating data and training model...", self.model_file)
             data = self.generate_data()
 
             # Feature columns (excluding 'timestamp' and 'yellowing')
-            X = data.drop(columns=['timestamp', 'yellowing'])
+            X = data[self.feature_names]
             y = data['yellowing']
 
             # Split data into training and testing sets
@@ -36,18 +113,38 @@ class HealthModel:
 
             # Train the model
             self.train_model(X_train, y_train)
+            if temporal_features:
+                self.save_window(SYNTHETIC_INTERVAL)
 
             # Evaluate the model
             self.evaluate_model(X_test, y_test)
 
+        if compiled and self.booster is not None:
+            self.compile_grid()
+
     def setup(self):
+        start = time.perf_counter()
         try:
-            self.model = joblib.load(self.model_file)
-            print("Model loaded successfully.")
+            import xgboost
+
+            self.booster = xgboost.Booster(model_file=self.model_file)
+            self.load_seconds = time.perf_counter() - start
+            logger.info("Model loaded successfully in %.0f ms.", self.load_seconds * 1000)
+            if self.load_seconds > STARTUP_BUDGET_SECONDS:
+                logger.warning("Model load exceeded the %ss startup budget", STARTUP_BUDGET_SECONDS)
         except Exception as e:
-            print(f"Error loading model: {e}")
+            logger.error("Error loading model: %s", e)
+
+    def convert_legacy_model(self, legacy_file):
+        # One-off conversion of the pickled classifier to the native format
+        import joblib
+
+        logger.info("Converting %s to %s", legacy_file, self.model_file)
+        joblib.load(legacy_file).save_model(self.model_file)
 
     def train_model(self, X_train, y_train):
+        from xgboost import XGBClassifier
+
         xgb_model = XGBClassifier(
             colsample_bytree=0.8,
             learning_rate=0.01,
@@ -59,116 +156,174 @@ class HealthModel:
         )
         # Train the model
         xgb_model.fit(X_train, y_train)
-        # Save the trained model
-        joblib.dump(xgb_model, self.model_file)
-        print(f"Model trained and saved as {self.model_file}.")
+        # Save the trained model in XGBoost's native format
+        xgb_model.save_model(self.model_file)
+        logger.info("Model trained and saved as %s.", self.model_file)
         self.model = xgb_model
+        self.booster = xgb_model.get_booster()
 
     def evaluate_model(self, X_test, y_test):
         """Evaluate the trained model."""
+        from sklearn.metrics import accuracy_score, classification_report, confusion_matrix
+
         y_pred = self.model.predict(X_test)
 
-        # Print evaluation results
+        # Log evaluation results
         accuracy = accuracy_score(y_test, y_pred)
-        print(f"Test Accuracy: {accuracy:.4f}")
-        print("Classification Report:")
-        print(classification_report(y_test, y_pred))
-        print("Confusion Matrix:")
-        print(confusion_matrix(y_test, y_pred))
+        logger.info("Test Accuracy: %.4f", accuracy)
+        logger.info("Classification Report:\n%s", classification_report(y_test, y_pred))
+        logger.info("Confusion Matrix:\n%s", confusion_matrix(y_test, y_pred))
 
     def generate_seasonal_trends(self, days_from_start):
+        # Works on a single day or a whole array of days at once
+        days_from_start = np.asarray(days_from_start)
         season = (days_from_start // 30) % 4  # Rough seasonal cycle based on 30-day months
         time_of_day = np.sin(2 * np.pi * (days_from_start % 24) / 24)  # Sine wave for daily temperature fluctuation
 
-        if season == 0:  # Spring
-            temp_base = 15 + 10 * time_of_day
-        elif season == 1:  # Summer
-            temp_base = 25 + 10 * time_of_day
-        elif season == 2:  # Fall
-            temp_base = 20 + 10 * time_of_day
-        else:  # Winter
-            temp_base = 10 + 10 * time_of_day
+        # Spring, Summer, Fall, Winter
+        temp_base = SEASON_BASE_TEMPS[season] + 10 * time_of_day
 
         # Humidity: 40% to 90%, higher humidity in morning and lower in afternoon
-        humidity_base = 60 + 20 * np.sin(2 * np.pi * (days_from_start % 24) / 24)
+        humidity_base = 60 + 20 * time_of_day
 
         # Soil moisture: More wet after rain, drier in the afternoon
-        moisture_base = 50 + 30 * np.sin(2 * np.pi * (days_from_start % 24) / 24)
-        moisture_base = min(max(moisture_base, 20), 80)
+        moisture_base = np.clip(50 + 30 * time_of_day, 20, 80)
 
         # Classify moisture as binary: 1 for wet, 0 for dry
-        moisture_class = 1 if moisture_base > 35 else 0
+        moisture_class = (moisture_base > 35).astype(np.int64)
 
         # pH: Could range from 5.5 to 7.5 depending on soil
         ph_base = 6.5 + 0.5 * np.sin(2 * np.pi * (days_from_start % 30) / 30)
 
         return temp_base, humidity_base, moisture_class, ph_base
 
-    def simulate_yellowing(self, temp, humidity, moisture, ph):
-        yellowing_probability = 0
-        if temp > 30:  # Heat stress
-            yellowing_probability += 0.3
-        if humidity < 50:  # Dry conditions
-            yellowing_probability += 0.3
-        if moisture == 0:  # Dry soil (binary moisture)
-            yellowing_probability += 0.4
-        if ph < 6 or ph > 7:  # Extreme pH conditions
-            yellowing_probability += 0.2
-
-        yellowing_probability = min(yellowing_probability, 1.0)  # Limit to 1.0
-        return choices([0, 1], weights=[1 - yellowing_probability, yellowing_probability])[0]
+    def simulate_yellowing(self, temp, humidity, moisture, ph, sustained_dry=None):
+        # Stress probabilities add up per condition, drawn for every row at once
+        yellowing_probability = (0.3 * (np.asarray(temp) > 30) +  # Heat stress
+                                 0.3 * (np.asarray(humidity) < 50) +  # Dry conditions
+                                 0.4 * (np.asarray(moisture) == 0) +  # Dry soil (binary moisture)
+                                 0.2 * ((np.asarray(ph) < 6) | (np.asarray(ph) > 7)))  # Extreme pH conditions
+        if sustained_dry is not None:
+            # Soil that stayed dry for the whole window stresses the plant further
+            yellowing_probability = yellowing_probability + 0.3 * np.asarray(sustained_dry)
+
+        yellowing_probability = np.minimum(yellowing_probability, 1.0)  # Limit to 1.0
+        return (self.rng.random(yellowing_probability.shape) < yellowing_probability).astype(np.int64)
+
+    def timestamps(self, start, count):
+        # One timestamp per day from start_date
+        return np.datetime64(self.start_date) + np.arange(start, start + count).astype('timedelta64[D]')
+
+    def generate_constant_data(self, num_points, temp, humidity, moisture, ph, yellowing):
+        import pandas as pd
+
+        columns = {
+            'timestamp': self.timestamps(0, num_points),
+            'temperature': np.full(num_points, temp),
+            'humidity': np.full(num_points, humidity),
+            'moisture': np.full(num_points, moisture),
+            'ph': np.full(num_points, ph),
+            'yellowing': np.full(num_points, yellowing),
+        }
+        if self.temporal_features:
+            columns.update(self.rolling_columns(columns))
+        return pd.DataFrame(columns)
 
     def generate_optimal_condition_data(self, num_points=100):
-        data = []
-        for i in range(num_points):
-            # Extreme conditions that cause yellowing (optimal conditions for yellowing)
-            temp, humidity, moisture, ph = 35, 40, 0, 6.5  # Wet soil (moisture = 1)
-            yellowing = 1  # Yellowing detected
-            timestamp = self.start_date + timedelta(days=i)
-            data.append([timestamp, temp, humidity, moisture, ph, yellowing])
-
-        # Convert to DataFrame
-        df = pd.DataFrame(data, columns=['timestamp', 'temperature', 'humidity', 'moisture', 'ph', 'yellowing'])
-        return df
+        # Extreme conditions that cause yellowing (optimal conditions for yellowing)
+        return self.generate_constant_data(num_points, temp=35, humidity=40, moisture=0, ph=6.5, yellowing=1)
 
     def generate_non_optimal_condition_data(self, num_points=100):
-        data = []
-        for i in range(num_points):
-            # Non-optimal conditions (slightly adjusted features but yellowing occurs)
-            temp, humidity, moisture, ph = 22, 70, 0, 6.5  # Dry soil (moisture = 0)
-            yellowing = 1  # Yellowing detected
-            timestamp = self.start_date + timedelta(days=i)
-            data.append([timestamp, temp, humidity, moisture, ph, yellowing])
-
-        # Convert to DataFrame
-        df = pd.DataFrame(data, columns=['timestamp', 'temperature', 'humidity', 'moisture', 'ph', 'yellowing'])
-        return df
-
-    def generate_data(self):
-        data = []
-        current_date = self.start_date
-        for record_id in range(self.num_records):
-            days_from_start = record_id
-            temp, humidity, moisture, ph = self.generate_seasonal_trends(days_from_start)
+        # Non-optimal conditions (slightly adjusted features but yellowing occurs)
+        return self.generate_constant_data(num_points, temp=22, humidity=70, moisture=0, ph=6.5, yellowing=1)
+
+    def window_size(self, interval_seconds) -> int:
+        # Readings taken every interval_seconds that make up the temporal window
+        return max(1, round(self.temporal_window_days * 86400 / interval_seconds))
+
+    @property
+    def window_file(self) -> str:
+        return self.model_file + '.window.json'
+
+    def save_window(self, interval_seconds) -> None:
+        # Records the window the model was trained with next to the model file
+        self.window_interval = interval_seconds
+        with open(self.window_file, 'w') as file:
+            json.dump({'window_days': self.temporal_window_days, 'row_interval': interval_seconds,
+                       'window_rows': self.window_size(interval_seconds)}, file)
+
+    def load_window(self) -> None:
+        # A temporal model is only valid with the window it was trained on
+        try:
+            with open(self.window_file) as file:
+                window = json.load(file)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"{self.model_file} has no readable window file {self.window_file}, "
+                             f"retrain the temporal model") from e
+        if window['window_days'] != self.temporal_window_days:
+            raise ValueError(f"{self.model_file} was trained on a {window['window_days']} day window, "
+                             f"not {self.temporal_window_days}")
+        self.window_interval = window['row_interval']
+
+    def window_stride(self, interval_seconds) -> int:
+        # Samples taken every interval_seconds per row of the trained window
+        stride = self.window_interval / interval_seconds
+        if stride < 1 or abs(stride - round(stride)) > 1e-6:
+            raise ValueError(f"The model's window has a row every {self.window_interval}s, "
+                             f"which is not a whole number of {interval_seconds}s samples")
+        return round(stride)
+
+    def rolling_columns(self, columns, warmup=0) -> dict:
+        # Temporal feature columns for rows in time order, computed by the same RollingWindow used when
+        # monitoring. The first warmup rows only fill the window and are left out of the result
+        window = RollingWindow(self.window_size(SYNTHETIC_INTERVAL))
+        rows = [window.push({name: columns[name][i] for name in FEATURES}) for i in range(len(columns[FEATURES[0]]))]
+        return {name: np.array([row[name] for row in rows[warmup:]]) for name in TEMPORAL_FEATURES}
+
+    def generate_columns(self, start, count) -> dict:
+        # Records start .. start + count as whole NumPy columns, one record per day
+        days_from_start = np.arange(start, start + count)
+        temp, humidity, moisture, ph = self.generate_seasonal_trends(days_from_start)
+
+        if not self.temporal_features:
             yellowing = self.simulate_yellowing(temp, humidity, moisture, ph)
-
-            # Prepare the data entry
-            entry = {
-                'timestamp': current_date,
-                'temperature': temp,
-                'humidity': humidity,
-                'moisture': moisture,
-                'ph': ph,
-                'yellowing': yellowing
-            }
-            data.append(entry)
-
-            # Increment the current date by one day
-            current_date += timedelta(days=1)
-
-        return pd.DataFrame(data)
+            temporal = {}
+        else:
+            # The trends don't depend on the random generator, so the days before start are regenerated to
+            # fill the window. Twenty windows back the EWMA has forgotten where it started, so chunks line up
+            warmup = min(start, 20 * self.window_size(SYNTHETIC_INTERVAL))
+            history = dict(zip(FEATURES, self.generate_seasonal_trends(np.arange(start - warmup, start + count))))
+            temporal = self.rolling_columns(history, warmup)
+            yellowing = self.simulate_yellowing(temp, humidity, moisture, ph,
+                                                sustained_dry=temporal['moisture_max'] == 0)
+
+        return {
+            'timestamp': self.timestamps(start, count),
+            'temperature': temp,
+            'humidity': humidity,
+            'moisture': moisture,
+            'ph': ph,
+            'yellowing': yellowing,
+            **temporal
+        }
+
+    def iter_data_chunks(self, num_records=None, chunk_size=100000):
+        # Lazily yields DataFrames of at most chunk_size records, so large sets never sit in memory at once
+        import pandas as pd
+
+        num_records = self.num_records if num_records is None else num_records
+        for start in range(0, num_records, chunk_size):
+            yield pd.DataFrame(self.generate_columns(start, min(chunk_size, num_records - start)))
+
+    def generate_data(self, num_records=None):
+        import pandas as pd
+
+        num_records = self.num_records if num_records is None else num_records
+        return pd.DataFrame(self.generate_columns(0, num_records))
 
     def test_model(self, optimal_points=100, non_optimal_points=100):
+        import pandas as pd
+
         # Generate optimal and non-optimal condition data for prediction
         optimal_data = self.generate_optimal_condition_data(num_points=optimal_points)
         non_optimal_data = self.generate_non_optimal_condition_data(num_points=non_optimal_points)
@@ -183,7 +338,7 @@ class HealthModel:
         y_pred_actual = full_data['yellowing']
 
         # Predict on the generated data using the loaded model
-        predictions = self.model.predict(X_pred)
+        predictions = self.predict_yellowing(X_pred[self.feature_names].to_numpy(dtype=np.float32))
 
         # Count correct predictions for optimal and non-optimal data
         correct_optimal_predictions = sum(
@@ -191,21 +346,208 @@ class HealthModel:
         correct_non_optimal_predictions = sum(
             pred == actual for pred, actual in zip(predictions[optimal_points:], y_pred_actual[optimal_points:]))
 
-        # Print the results
-        print(f"Correct Predictions for Optimal Conditions: {correct_optimal_predictions}/{optimal_points}")
-        print(f"Correct Predictions for Non-Optimal Conditions: {correct_non_optimal_predictions}/{non_optimal_points}")
+        # Log the results
+        logger.info("Correct Predictions for Optimal Conditions: %s/%s", correct_optimal_predictions, optimal_points)
+        logger.info("Correct Predictions for Non-Optimal Conditions: %s/%s", correct_non_optimal_predictions,
+                    non_optimal_points)
+
+    def feature_vector(self, entry):
+        # Fixed-order float32 row, missing readings (and temporal features not in the entry) become NaN,
+        # which the booster treats as missing
+        return np.array([[np.nan if entry.get(name) is None else entry[name] for name in self.feature_names]],
+                        dtype=np.float32)
+
+    def feature_matrix(self, entries):
+        # Accepts a list of entry dicts or a mapping of column arrays
+        if isinstance(entries, dict):
+            return np.column_stack([np.asarray(entries[name], dtype=np.float32) for name in self.feature_names])
+        return np.array([[np.nan if entry.get(name) is None else entry[name] for name in self.feature_names]
+                         for entry in entries], dtype=np.float32).reshape(-1, len(self.feature_names))
+
+    def predict_yellowing(self, X):
+        # Same 0.5 cut-off XGBClassifier.predict uses, straight on the booster with NumPy input
+        probabilities = self.booster.inplace_predict(X)
+        return (probabilities > 0.5).astype(np.int8)
+
+    def split_thresholds(self) -> dict:
+        # Feature name -> sorted float32 split conditions used anywhere in the booster
+        names = self.booster.feature_names or [f"f{i}" for i in range(len(self.feature_names))]
+        by_split = {split: self.feature_names[i] for i, split in enumerate(names)}
+        thresholds = {name: [] for name in self.feature_names}
+
+        def walk(node):
+            if 'split' in node:
+                thresholds[by_split[node['split']]].append(node['split_condition'])
+                for child in node['children']:
+                    walk(child)
+
+        for tree in self.booster.get_dump(dump_format='json'):
+            walk(json.loads(tree))
+        return {name: np.unique(np.array(values, dtype=np.float32)) for name, values in thresholds.items()}
+
+    def grid_key(self) -> str:
+        # Changes whenever the model file or anything the table was built from changes
+        digest = hashlib.sha256()
+        with open(self.model_file, 'rb') as file:
+            digest.update(file.read())
+        digest.update(json.dumps([GRID_VERSION, self.grid_bounds, self.grid_steps, OPTIMAL_TEMP_RANGE,
+                                  OPTIMAL_HUMIDITY_RANGE, OPTIMAL_PH_RANGE], sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def compile_grid(self) -> None:
+        # Loads the decision grid cached next to the model file, or builds and saves it
+        start = time.perf_counter()
+        path = self.model_file + '.grid.npz'
+        key = self.grid_key()
+
+        cached = None
+        if os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    if str(data['key']) == key:
+                        cached = data['grid'], [data[f"edges_{name}"] for name in GRID_AXES]
+            except (OSError, KeyError, ValueError) as e:
+                logger.warning("Ignoring unreadable decision grid %s: %s", path, e)
+
+        if cached is None:
+            cached = self.build_grid()
+            # Written to a temporary file and renamed, so a crash never leaves half a grid behind
+            temporary = path + '.tmp.npz'
+            try:
+                np.savez_compressed(temporary, key=np.array(key), grid=cached[0],
+                                    **{f"edges_{name}": edges for name, edges in zip(GRID_AXES, cached[1])})
+                os.replace(temporary, path)
+            except OSError as e:
+                # A read-only folder or a full card only costs the cache, the grid is still used from memory
+                logger.warning("Could not save decision grid %s, it will be rebuilt next start: %s", path, e)
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+
+        self.grid, self.grid_edges = cached
+        # Plain float lists for the single-entry lookup, bisect on a list beats NumPy for one value
+        self.grid_edge_lists = [edges.tolist() for edges in self.grid_edges]
+        self.grid_seconds = time.perf_counter() - start
+        logger.info("Decision grid ready in %.2f s, %.1f%% of cells need the booster",
+                    self.grid_seconds, 100 * np.mean(self.grid == GRID_EXACT))
+
+    def build_grid(self):
+        # The booster only compares each input against its split thresholds, and the optimal check against
+        # its range bounds, so between two neighbouring ones the decision cannot change. It is evaluated once
+        # per such region, every cell then takes the regions it overlaps, and a cell where they disagree
+        # is left to the booster
+        thresholds = self.split_thresholds()
+        optimal_ranges = {'temperature': OPTIMAL_TEMP_RANGE, 'humidity': OPTIMAL_HUMIDITY_RANGE,
+                          'ph': OPTIMAL_PH_RANGE}
+
+        edges, representatives, piece_regions, first_piece, uncertain = [], [], [], [], []
+        for name in GRID_AXES:
+            low, high = self.grid_bounds[name]
+            cells = int(round((high - low) / self.grid_steps[name]))
+            # float32 like the booster's inputs, so a reading lands in a cell by the same comparisons
+            axis_edges = (low + self.grid_steps[name] * np.arange(cells + 1)).astype(np.float32)
+
+            # The upper optimal bound is inclusive, the region beyond it starts one float32 later
+            bound_low, bound_high = np.float32(optimal_ranges[name])
+            splits = np.union1d(thresholds[name], [bound_low, np.nextafter(bound_high, np.float32(np.inf))])
+
+            # Pieces run from one cell edge or split to the next, each lies in one cell and one region
+            inside = splits[(splits > axis_edges[0]) & (splits < axis_edges[-1])]
+            piece_starts = np.union1d(axis_edges[:-1], inside)
+            owner = np.searchsorted(axis_edges, piece_starts, side='right') - 1
+            regions, first, inverse = np.unique(np.searchsorted(splits, piece_starts, side='right'),
+                                                return_index=True, return_inverse=True)
+
+            # The optimal check itself runs on the unrounded readings, in the cell holding a bound
+            # they can fall either side of it
+            near = np.zeros(cells, dtype=bool)
+            for bound in (bound_low, bound_high):
+                near |= (axis_edges[:-1] <= bound) & (bound < axis_edges[1:])
+
+            edges.append(axis_edges)
+            # A piece's own start is in its region, so the first piece's start stands in for the region
+            representatives.append(piece_starts[first])
+            piece_regions.append(inverse.ravel())
+            first_piece.append(np.searchsorted(owner, np.arange(cells)))
+            uncertain.append(near)
+
+        # Humidity x pH plane of region representatives, the booster is evaluated one temperature region at a time
+        humidity_plane, ph_plane = (axis.ravel() for axis in np.meshgrid(*representatives[1:], indexing='ij'))
+        plane_shape = (len(representatives[1]), len(representatives[2]))
+        plane_pieces = np.ix_(piece_regions[1], piece_regions[2])
+
+        def cell_bounds(moisture, region):
+            # Highest and lowest decision in every humidity x pH cell for one temperature region
+            X = np.empty((len(humidity_plane), 4), dtype=np.float32)
+            X[:, 0] = representatives[0][region]
+            X[:, 1] = humidity_plane
+            X[:, 2] = moisture
+            X[:, 3] = ph_plane
+            predicted = self.predict_yellowing(X) == 1
+            optimal = self.optimal_conditions_mask(X[:, 0], X[:, 1], X[:, 2], X[:, 3])
+            decisions = (~predicted & optimal).reshape(plane_shape)[plane_pieces]
+            highest, lowest = decisions, decisions
+            for axis, pieces in enumerate(first_piece[1:]):
+                highest = np.maximum.reduceat(highest, pieces, axis=axis)
+                lowest = np.minimum.reduceat(lowest, pieces, axis=axis)
+            return highest, lowest
+
+        grid = np.empty((2,) + tuple(len(axis_edges) - 1 for axis_edges in edges), dtype=np.int8)
+        piece_ends = np.append(first_piece[0][1:], len(piece_regions[0]))
+        for moisture in (0, 1):
+            # Regions only ever increase along the temperature axis, so just the current ones are kept
+            bounds = {}
+            for cell, (first, end) in enumerate(zip(first_piece[0], piece_ends)):
+                regions = np.unique(piece_regions[0][first:end]).tolist()
+                bounds = {region: bounds[region] if region in bounds else cell_bounds(moisture, region)
+                          for region in regions}
+                highest = np.logical_or.reduce([bounds[region][0] for region in regions])
+                lowest = np.logical_and.reduce([bounds[region][1] for region in regions])
+                grid[moisture, cell] = np.where(highest == lowest, highest, GRID_EXACT)
+
+        grid[:, uncertain[0][:, None, None] | uncertain[1][None, :, None] | uncertain[2][None, None, :]] = GRID_EXACT
+        return grid, edges
+
+    def grid_code(self, entry) -> int:
+        # GRID_* value for one entry, GRID_EXACT when it falls outside the grid or a reading is missing
+        moisture = entry.get('moisture')
+        if moisture not in (0, 1):
+            return GRID_EXACT
+        index = [int(moisture)]
+        for name, edges in zip(GRID_AXES, self.grid_edge_lists):
+            value = entry.get(name)
+            if value is None:
+                return GRID_EXACT
+            # Rounded to float32 first, the booster sees the same value
+            position = bisect_right(edges, float(np.float32(value))) - 1
+            if not 0 <= position < len(edges) - 1:
+                return GRID_EXACT
+            index.append(position)
+        return int(self.grid[tuple(index)])
+
+    def grid_codes(self, X):
+        # Vectorised grid_code over a feature matrix
+        moisture = X[:, FEATURES.index('moisture')]
+        valid = (moisture == 0) | (moisture == 1)
+        index = [np.where(valid, moisture, 0).astype(np.intp)]
+        for name, edges in zip(GRID_AXES, self.grid_edges):
+            # NaN sorts after every edge, so missing readings fall outside too
+            position = np.searchsorted(edges, X[:, FEATURES.index(name)], side='right') - 1
+            valid &= (position >= 0) & (position < len(edges) - 1)
+            index.append(np.where(valid, position, 0))
+        return np.where(valid, self.grid[tuple(index)], GRID_EXACT).astype(np.int8)
 
     def predict_disease(self, entry):
-        # Convert the entry dict into a pandas DataFrame for model prediction
-        df = pd.DataFrame([entry])
+        if self.grid is not None:
+            # A single table lookup, unless the entry sits on a decision boundary
+            code = self.grid_code(entry)
+            if code != GRID_EXACT:
+                return 1 if code == GRID_DISEASE_IF_YELLOW and entry['yellowing'] == 1 else 0
 
-        print(f"DF: {df}")
-
-        # Drop the 'timestamp' and 'yellowing' columns for prediction
-        X_pred = df.drop(columns=['timestamp', 'yellowing', 'image_name'])
+        # Build the feature row directly from the entry dict, no DataFrame needed
+        X_pred = self.feature_vector(entry)
 
         # Predict yellowing using the model
-        predicted_yellowing = self.model.predict(X_pred)[0]  # Get the prediction for this entry
+        predicted_yellowing = self.predict_yellowing(X_pred)[0]  # Get the prediction for this entry
 
         # If the model predicts no yellowing, but the actual yellowing value is 1,
         # and environmental conditions are optimal (we define them as non-stressful), it's likely due to disease.
@@ -217,20 +559,53 @@ class HealthModel:
 
         return 0  # No disease, either because the model predicts yellowing or because conditions are not optimal.
 
+    def predict_disease_many(self, entries):
+        # Vectorised predict_disease, returns an int8 array with one disease flag per entry
+        X_pred = self.feature_matrix(entries)
+        if isinstance(entries, dict):
+            yellowing = np.asarray(entries['yellowing'])
+        else:
+            yellowing = np.array([entry['yellowing'] for entry in entries])
+
+        if self.grid is None:
+            return self.exact_disease(X_pred, yellowing)
+
+        # Looked up in the decision grid, only rows on a decision boundary go to the booster
+        codes = self.grid_codes(X_pred)
+        disease = ((codes == GRID_DISEASE_IF_YELLOW) & (yellowing == 1)).astype(np.int8)
+        exact = codes == GRID_EXACT
+        if exact.any():
+            disease[exact] = self.exact_disease(X_pred[exact], yellowing[exact])
+        return disease
+
+    def exact_disease(self, X_pred, yellowing):
+        predicted_yellowing = self.predict_yellowing(X_pred)
+        optimal = self.optimal_conditions_mask(X_pred[:, 0], X_pred[:, 1], X_pred[:, 2], X_pred[:, 3])
+
+        return ((predicted_yellowing == 0) & (yellowing == 1) & optimal).astype(np.int8)
+
+    @staticmethod
+    def optimal_conditions_mask(temp, humidity, moisture, ph):
+        # Array version of is_optimal_conditions, NaN readings are never optimal.
+        # Like is_optimal_conditions, moisture does not narrow the check
+        return ((OPTIMAL_TEMP_RANGE[0] <= temp) & (temp <= OPTIMAL_TEMP_RANGE[1]) &
+                (OPTIMAL_HUMIDITY_RANGE[0] <= humidity) & (humidity <= OPTIMAL_HUMIDITY_RANGE[1]) &
+                (OPTIMAL_PH_RANGE[0] <= ph) & (ph <= OPTIMAL_PH_RANGE[1]))
+
     def is_optimal_conditions(self, temp, humidity, moisture, ph):
         # Optimal conditions (e.g., ranges for healthy plant conditions)
-        optimal_temp_range = (20, 30)  # Temperature between 20°C and 30°C
-        optimal_humidity_range = (50, 80)  # Humidity between 50% and 80%
+        optimal_temp_range = OPTIMAL_TEMP_RANGE
+        optimal_humidity_range = OPTIMAL_HUMIDITY_RANGE
         optimal_moisture = 1  # Moisture between 30% and 70%
-        optimal_ph_range = (6.0, 7.5)  # pH between 6.0 and 7.5
+        optimal_ph_range = OPTIMAL_PH_RANGE
 
         # Check if the conditions fall within the optimal ranges
         if (optimal_temp_range[0] <= temp <= optimal_temp_range[1] and
                 optimal_humidity_range[0] <= humidity <= optimal_humidity_range[1] and
                 optimal_moisture == 1 and optimal_ph_range[0] <= ph <= optimal_ph_range[1]):
-            print("OPTIMAL")
+            logger.debug("OPTIMAL")
             return True  # The conditions are optimal
-        print("NOT OPTIMAL")
+        logger.debug("NOT OPTIMAL")
         return False  # The conditions are not optimal
 
 # if __name__ == '__main__':
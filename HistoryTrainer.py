@@ -0,0 +1,146 @@
+import argparse
+import glob
+import logging
+import os
+
+import numpy as np
+import xgboost
+
+from DataHandler import DataHandler
+from HealthModel import HealthModel, FEATURES, TEMPORAL_FEATURES
+from RollingWindow import RollingWindow
+
+logger = logging.getLogger(__name__)
+
+# CSV column each model feature is read from
+CSV_COLUMNS = {'temperature': 'temperature', 'humidity': 'humidity', 'moisture': 'soil_moisture', 'ph': 'ph'}
+
+# Same settings as HealthModel.train_model, hist is required for external memory
+TRAINING_PARAMS = {
+    'objective': 'binary:logistic',
+    'tree_method': 'hist',
+    'colsample_bytree': 0.8,
+    'eta': 0.01,
+    'max_depth': 5,
+    'min_child_weight': 1,
+    'subsample': 0.8,
+    'scale_pos_weight': 3,  # Adjust for class imbalance
+}
+
+
+class HistoryIter(xgboost.DataIter):
+    def __init__(self, paths, chunk_rows=50000, cache_dir='data/xgb_cache', window_size=None):
+        self.paths = paths
+        self.chunk_rows = chunk_rows
+        self.chunks = None
+
+        # Rows per temporal window, None trains on the instantaneous readings only
+        self.window_size = window_size
+        self.feature_names = FEATURES + TEMPORAL_FEATURES if window_size else list(FEATURES)
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # A cache prefix makes XGBoost page the data to disk instead of holding it in memory
+        super().__init__(cache_prefix=os.path.join(cache_dir, 'history'))
+
+    def read_chunks(self):
+        # Streams (features, labels) arrays of at most chunk_rows rows from every file in turn
+        import pandas as pd
+
+        columns = [CSV_COLUMNS[name] for name in FEATURES] + ['yellowing']
+        # One window across every file, the files are read in time order just as the readings were taken
+        window = RollingWindow(self.window_size) if self.window_size else None
+        for path in self.paths:
+            # Headerless legacy files are read with the original columns
+            header, has_header = DataHandler.read_header(path)
+            for chunk in pd.read_csv(path, usecols=columns, chunksize=self.chunk_rows,
+                                     header=0 if has_header else None, names=None if has_header else header):
+                X = chunk[[CSV_COLUMNS[name] for name in FEATURES]].to_numpy(dtype=np.float32)
+                if window is not None:
+                    # Every reading goes through the window, labelled or not, exactly as when monitoring
+                    rolling = [window.push(dict(zip(FEATURES, row))) for row in X.tolist()]
+                    temporal = np.array([[row[name] for name in TEMPORAL_FEATURES] for row in rolling],
+                                        dtype=np.float32).reshape(len(X), len(TEMPORAL_FEATURES))
+                    X = np.hstack([X, temporal])
+
+                # Rows without a yellowing label can't be trained on, missing features stay NaN
+                labelled = chunk['yellowing'].notna().to_numpy()
+                if not labelled.any():
+                    continue
+
+                y = chunk['yellowing'].to_numpy(dtype=np.float32)[labelled]
+                yield X[labelled], y
+
+    def next(self, input_data):
+        if self.chunks is None:
+            self.chunks = self.read_chunks()
+
+        try:
+            X, y = next(self.chunks)
+        except StopIteration:
+            return 0
+
+        input_data(data=X, label=y, feature_names=self.feature_names)
+        return 1
+
+    def reset(self):
+        self.chunks = None
+
+
+class HistoryTrainer:
+    def __init__(self, health_model, paths, chunk_rows=50000, cache_dir='data/xgb_cache', interval=10):
+        self.health_model = health_model
+        self.paths = paths
+        self.chunk_rows = chunk_rows
+        self.cache_dir = cache_dir
+        # Seconds between recorded readings, sets how many rows make up the model's temporal window
+        self.interval = interval
+
+    def train(self, num_boost_round=50, continue_training=True):
+        if self.health_model.temporal_features and continue_training \
+                and self.health_model.window_interval not in (None, self.interval):
+            # The existing trees saw windows with a different row spacing
+            raise ValueError(f"The model's window has a row every {self.health_model.window_interval}s, "
+                             f"retrain from scratch (--full) to use {self.interval}s readings")
+        window_size = self.health_model.window_size(self.interval) if self.health_model.temporal_features else None
+        iterator = HistoryIter(self.paths, chunk_rows=self.chunk_rows, cache_dir=self.cache_dir,
+                               window_size=window_size)
+        try:
+            dtrain = xgboost.DMatrix(iterator)
+            rows = dtrain.num_row()
+
+            # Add trees to the current booster instead of retraining from scratch
+            base_model = self.health_model.booster if continue_training else None
+            booster = xgboost.train(TRAINING_PARAMS, dtrain, num_boost_round=num_boost_round, xgb_model=base_model)
+        finally:
+            self.clear_cache()
+
+        booster.save_model(self.health_model.model_file)
+        if self.health_model.temporal_features:
+            self.health_model.save_window(self.interval)
+        self.health_model.booster = booster
+        logger.info("Model trained on %s recorded rows and saved as %s.", rows, self.health_model.model_file)
+        return booster
+
+    def clear_cache(self) -> None:
+        for path in glob.glob(os.path.join(self.cache_dir, 'history*')):
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Update the health model from recorded readings")
+    parser.add_argument('--rounds', type=int, default=50, help="boosting rounds to add")
+    parser.add_argument('--full', action='store_true', help="retrain from scratch instead of continuing")
+    parser.add_argument('--chunk-rows', type=int, default=50000)
+    parser.add_argument('--temporal', action='store_true', help="train the model with rolling window features")
+    parser.add_argument('--interval', type=float, default=10, help="seconds between recorded readings")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    data_handler = DataHandler(read_only=True)
+
+    health_model = HealthModel(temporal_features=args.temporal)
+    trainer = HistoryTrainer(health_model, data_handler.data_files(), chunk_rows=args.chunk_rows,
+                             interval=args.interval)
+    trainer.train(num_boost_round=args.rounds, continue_training=not args.full)
@@ -1,10 +1,14 @@
+import logging
+
 import Adafruit_DHT
 
+logger = logging.getLogger(__name__)
+
 
 class TempHumidity:
-    def __init__(self):
+    def __init__(self, sensor_pin=19):
         self.sensor = Adafruit_DHT.DHT22
-        self.sensor_pin = 19  # GPIO19 is physical pin 35
+        self.sensor_pin = sensor_pin  # GPIO19 is physical pin 35 by default
 
     def get_reading(self) -> dict:
         # Temperature data is in Celcius (22.0)
@@ -18,9 +22,8 @@ class TempHumidity:
                 'humidity': round(humidity, 2)
             }
 
-            # print for logging
-            print(f"Temp: {temperature:.1f}°C  |  Humidity: {humidity:.1f}%")
+            logger.debug("Temp: %.1f°C  |  Humidity: %.1f%%", temperature, humidity)
             return sensor_data
         else:
-            print("Invalid data: Temperature or Humidity is None.")
+            logger.warning("Invalid data: Temperature or Humidity is None.")
             raise Exception("Invalid Sensor Reading")
@@ -0,0 +1,255 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def shard_folder(root, filename, timestamp=None) -> str:
+    # processed_images/YYYY/MM/DD, dated from the Camera filename (YYYYMMDD_HHMMSS.jpg) when it has one
+    try:
+        date = datetime.strptime(os.path.basename(filename)[:8], "%Y%m%d")
+    except ValueError:
+        date = datetime.fromtimestamp(timestamp if timestamp is not None else time.time())
+    return os.path.join(root, date.strftime("%Y"), date.strftime("%m"), date.strftime("%d"))
+
+
+def average_hash(frame) -> int:
+    # 64-bit perceptual hash: 8x8 greyscale thumbnail, one bit per pixel brighter than the mean
+    grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    small = cv2.resize(grey, (8, 8), interpolation=cv2.INTER_AREA)
+    bits = (small > small.mean()).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hue_histogram(frame, bins=18) -> np.ndarray:
+    # Normalised hue histogram of the coloured pixels. Yellowing shifts hue while barely changing
+    # brightness, so the greyscale hash alone would call a yellowing leaf a duplicate
+    hsv = cv2.cvtColor(cv2.resize(frame, (64, 48), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2HSV)
+    coloured = hsv[..., 1] > 40
+    histogram = np.bincount((hsv[..., 0][coloured].astype(np.int32) * bins) // 180, minlength=bins).astype(np.float64)
+    total = histogram.sum()
+    return histogram / total if total else histogram
+
+
+def capture_time(path) -> float:
+    # Capture time from the Camera filename (YYYYMMDD_HHMMSS...), the file's mtime otherwise
+    try:
+        return datetime.strptime(os.path.basename(path)[:15], "%Y%m%d_%H%M%S").timestamp()
+    except ValueError:
+        return os.path.getmtime(path)
+
+
+class ImageLifecycle:
+    def __init__(self, unprocessed_folder='unprocessed_images', processed_folder='processed_images',
+                 jpeg_quality=80, thumbnail_width=160, duplicate_distance=None, duplicate_hue_distance=0.05,
+                 duplicate_window=300.0, duplicates_folder='duplicate_images', duplicate_retention_days=7,
+                 max_bytes=None, max_age_days=None, min_file_age=30.0, interval=60.0, max_per_pass=20, pause=0.2):
+        self.unprocessed_folder = unprocessed_folder
+        self.processed_folder = processed_folder
+
+        # JPEG re-encoding quality, images that come out larger and other formats are moved unchanged
+        self.jpeg_quality = jpeg_quality
+        self.thumbnail_width = thumbnail_width
+        # A frame is a duplicate of the previous kept frame from the same camera when their hashes differ in at
+        # most duplicate_distance bits, their hue histograms by at most duplicate_hue_distance (L1), and they were
+        # taken within duplicate_window seconds of each other. None keeps every frame
+        self.duplicate_distance = duplicate_distance
+        self.duplicate_hue_distance = duplicate_hue_distance
+        self.duplicate_window = duplicate_window
+        # Duplicates are moved here rather than deleted, and pruned after duplicate_retention_days
+        self.duplicates_folder = duplicates_folder
+        self.duplicate_retention_days = duplicate_retention_days
+
+        # Retention limits for processed_images, None disables a limit
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+
+        # Files younger than this may still be being written by the ImageWriter, they are left for a later pass
+        self.min_file_age = min_file_age
+        # Throttling: seconds between passes, files per pass and a pause after each file
+        self.interval = interval
+        self.max_per_pass = max_per_pass
+        self.pause = pause
+
+        # Camera name suffix -> (capture time, hash, hue histogram) of its last kept frame,
+        # so stations sharing the folder are compared separately
+        self.last_kept = {}
+        self.stats = {'compacted': 0, 'duplicates': 0, 'retried': 0, 'expired': 0, 'bytes_saved': 0}
+
+        self.stop_event = threading.Event()
+        self.worker = None
+
+    def start(self) -> None:
+        self.worker = threading.Thread(target=self._run, name="ImageLifecycle", daemon=True)
+        self.worker.start()
+
+    def _run(self) -> None:
+        while not self.stop_event.is_set():
+            try:
+                self.run_pass()
+            except Exception:
+                logger.exception("Error managing images")
+            self.stop_event.wait(self.interval)
+
+    def pending_images(self) -> list:
+        # Oldest first, so duplicates are compared in capture order
+        if not os.path.exists(self.unprocessed_folder):
+            return []
+        return sorted(
+            os.path.join(self.unprocessed_folder, filename) for filename in os.listdir(self.unprocessed_folder)
+            if filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+
+    def run_pass(self) -> int:
+        handled = 0
+        now = time.time()
+        for path in self.pending_images():
+            if handled >= self.max_per_pass or self.stop_event.is_set():
+                break
+            try:
+                if now - os.path.getmtime(path) < self.min_file_age:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            with metrics.span('compact'):
+                processed = self.process_image(path)
+            if processed:
+                handled += 1
+                # Give the monitoring loop and the SD card room between files
+                self.stop_event.wait(self.pause)
+
+        self.apply_retention()
+        return handled
+
+    def process_image(self, path) -> bool:
+        frame = cv2.imread(path)
+        if frame is None:
+            # Most likely still being written, try again next pass
+            self.stats['retried'] += 1
+            return False
+
+        filename = os.path.basename(path)
+        camera = os.path.splitext(filename)[0][len("YYYYMMDD_HHMMSS"):]
+        if self.duplicate_distance is not None:
+            kept = (capture_time(path), average_hash(frame), hue_histogram(frame))
+            if self.is_duplicate(kept, self.last_kept.get(camera)):
+                os.makedirs(self.duplicates_folder, exist_ok=True)
+                shutil.move(path, os.path.join(self.duplicates_folder, filename))
+                self.stats['duplicates'] += 1
+                metrics.increment('images_deduplicated_total')
+                logger.info("Moved near-duplicate image %s to %s", path, self.duplicates_folder)
+                return True
+            self.last_kept[camera] = kept
+
+        folder = shard_folder(self.processed_folder, filename, os.path.getmtime(path))
+        os.makedirs(os.path.join(folder, 'thumbnails'), exist_ok=True)
+        destination = os.path.join(folder, filename)
+
+        # Write to a temporary name first so a crash never leaves a half-written image under the real name
+        temporary = destination + '.tmp.jpg'
+        original_size = os.path.getsize(path)
+        if filename.lower().endswith(('.jpg', '.jpeg')) and cv2.imwrite(temporary, frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]) \
+                and os.path.getsize(temporary) < original_size:
+            self.stats['bytes_saved'] += original_size - os.path.getsize(temporary)
+            os.replace(temporary, destination)
+            os.remove(path)
+        else:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            shutil.move(path, destination)
+
+        height, width = frame.shape[:2]
+        thumbnail_height = max(1, round(height * self.thumbnail_width / width))
+        thumbnail = cv2.resize(frame, (self.thumbnail_width, thumbnail_height), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(os.path.join(folder, 'thumbnails', filename), thumbnail, [cv2.IMWRITE_JPEG_QUALITY, 70])
+
+        self.stats['compacted'] += 1
+        return True
+
+    def is_duplicate(self, frame, previous) -> bool:
+        if previous is None:
+            return False
+        taken, image_hash, hues = frame
+        previous_taken, previous_hash, previous_hues = previous
+        return (0 <= taken - previous_taken <= self.duplicate_window
+                and bin(image_hash ^ previous_hash).count('1') <= self.duplicate_distance
+                and np.abs(hues - previous_hues).sum() <= self.duplicate_hue_distance)
+
+    def day_folders(self) -> list:
+        # (date, folder) for every day shard, oldest first
+        days = []
+        for root, folders, _ in os.walk(self.processed_folder):
+            relative = os.path.relpath(root, self.processed_folder).split(os.sep)
+            if len(relative) == 3:
+                try:
+                    days.append((datetime.strptime(''.join(relative), "%Y%m%d"), root))
+                except ValueError:
+                    pass
+                folders[:] = []
+        return sorted(days)
+
+    @staticmethod
+    def folder_bytes(folder) -> int:
+        total = 0
+        for root, _, files in os.walk(folder):
+            for filename in files:
+                total += os.path.getsize(os.path.join(root, filename))
+        return total
+
+    def prune_duplicates(self) -> None:
+        if self.duplicate_retention_days is None or not os.path.isdir(self.duplicates_folder):
+            return
+        cutoff = time.time() - self.duplicate_retention_days * 86400
+        for filename in os.listdir(self.duplicates_folder):
+            path = os.path.join(self.duplicates_folder, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def apply_retention(self) -> None:
+        self.prune_duplicates()
+        if self.max_bytes is None and self.max_age_days is None:
+            return
+
+        days = self.day_folders()
+        if self.max_age_days is not None:
+            cutoff = datetime.now() - timedelta(days=self.max_age_days)
+            while days and days[0][0] < cutoff:
+                self.expire(days.pop(0)[1])
+
+        if self.max_bytes is not None:
+            sizes = [self.folder_bytes(folder) for _, folder in days]
+            total = sum(sizes)
+            # Whole days are dropped oldest first, the current day is always kept
+            while total > self.max_bytes and len(days) > 1:
+                _, folder = days.pop(0)
+                total -= sizes.pop(0)
+                self.expire(folder)
+
+    def expire(self, folder) -> None:
+        shutil.rmtree(folder, ignore_errors=True)
+        # Drop the month and year folders once their last day is gone
+        for parent in (os.path.dirname(folder), os.path.dirname(os.path.dirname(folder))):
+            if os.path.isdir(parent) and not os.listdir(parent):
+                os.rmdir(parent)
+        self.stats['expired'] += 1
+        logger.info("Removed expired images in %s", folder)
+
+    def close(self) -> None:
+        self.stop_event.set()
+        if self.worker is not None and self.worker.is_alive():
+            self.worker.join()
@@ -0,0 +1,56 @@
+import logging
+import queue
+import threading
+
+import cv2
+
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ImageWriter:
+    def __init__(self, max_queue=32):
+        # Frames waiting to be encoded and written to disk
+        self.queue = queue.Queue(maxsize=max_queue)
+
+        self.worker = threading.Thread(target=self._run, name="ImageWriter", daemon=True)
+        self.worker.start()
+
+    def write(self, filename: str, frame) -> None:
+        # Hand the frame to the background thread, the caller must not modify it afterwards
+        self.queue.put((filename, frame))
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+
+                filename, frame = item
+                with metrics.span('encode'):
+                    saved = cv2.imwrite(filename, frame)
+                if saved:
+                    logger.debug("image saved as %s", filename)
+                else:
+                    logger.error("failed to save image %s", filename)
+            except Exception:
+                logger.exception("Error saving image")
+            finally:
+                self.queue.task_done()
+
+    def flush(self) -> None:
+        # Block until every queued frame has been written
+        self.queue.join()
+
+    def close(self) -> None:
+        if self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
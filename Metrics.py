@@ -0,0 +1,179 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds, from sub-millisecond sensor reads up to multi-second DHT retries
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Exported file formats
+PROMETHEUS = 'prometheus'
+JSON = 'json'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q) -> float:
+        # Upper bound of the bucket holding the q-th observation, enough to see where time goes
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+class Metrics:
+    def __init__(self, prefix='plant_monitor'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # (name, sorted label items) -> Histogram or counter value
+        self.histograms = {}
+        self.counters = {}
+
+        self.stop_event = threading.Event()
+        self.exporter = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    def observe(self, name, seconds, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def span(self, stage, **labels):
+        # Times the block into the stage_seconds histogram, failures are counted separately
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment('stage_errors_total', stage=stage, **labels)
+            raise
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            histograms = [
+                {'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                 'max': histogram.max, 'p50': histogram.quantile(0.5), 'p90': histogram.quantile(0.9),
+                 'p99': histogram.quantile(0.99), 'buckets': dict(zip(map(str, histogram.buckets), histogram.counts)),
+                 'inf': histogram.counts[-1]}
+                for (name, labels), histogram in self.histograms.items()
+            ]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in self.counters.items()]
+        return {'time': time.time(), 'histograms': histograms, 'counters': counters}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        def label_text(labels, extra=()):
+            items = list(labels.items()) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for histogram in snapshot['histograms']:
+            name = f"{self.prefix}_{histogram['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f"{name}_bucket{label_text(histogram['labels'], [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{label_text(histogram['labels'], [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{label_text(histogram['labels'])} {histogram['sum']}")
+            lines.append(f"{name}_count{label_text(histogram['labels'])} {histogram['count']}")
+        for counter in snapshot['counters']:
+            name = f"{self.prefix}_{counter['name']}"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{label_text(counter['labels'])} {counter['value']}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, file_format=PROMETHEUS) -> None:
+        # Written to a temporary file and renamed, so a scraper never reads a half-written file
+        text = self.to_json() if file_format == JSON else self.to_prometheus()
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        temporary = path + '.tmp'
+        try:
+            with open(temporary, 'w') as file:
+                file.write(text)
+            os.replace(temporary, path)
+        except OSError:
+            # e.g. a full disk, the partial temporary file isn't left behind
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def start_exporter(self, path, interval=60.0, file_format=PROMETHEUS) -> None:
+        def export():
+            try:
+                self.export(path, file_format)
+            except OSError as e:
+                logger.warning("Could not export metrics to %s: %s", path, e)
+
+        def run():
+            while not self.stop_event.wait(interval):
+                export()
+            # Final export so the last interval isn't lost on shutdown
+            export()
+
+        self.exporter = threading.Thread(target=run, name="MetricsExporter", daemon=True)
+        self.exporter.start()
+
+    def close(self) -> None:
+        self.stop_event.set()
+        if self.exporter is not None and self.exporter.is_alive():
+            self.exporter.join()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+# Shared by every module of the monitoring system
+metrics = Metrics()
@@ -1,22 +1,125 @@
+import logging
+import threading
+import time
+from collections import deque
+
 import RPi.GPIO as GPIO
 
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
 
 class Moisture:
-    def __init__(self):
-        self.sensor_pin = 13  # GPIO17 (Pin 33)
+    def __init__(self, sensor_pin=13, event_mode=False, bouncetime_ms=200, max_transitions=1024, clock=time.time):
+        self.sensor_pin = sensor_pin  # GPIO13 (Pin 33) by default
+
+        # In event mode wet/dry changes are recorded by an edge callback as they happen,
+        # instead of only being seen when a sample polls the pin
+        self.event_mode = event_mode
+        self.bouncetime_ms = bouncetime_ms
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        # (time, wet) for every transition, the oldest are dropped once max_transitions is reached
+        self.transitions = deque()
+        self.max_transitions = max_transitions
+        # State from the start of the history up to the first transition kept,
+        # moves forward whenever an old transition is dropped
+        self.baseline = None
+
         self.setup()
 
     def setup(self):
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(self.sensor_pin, GPIO.IN)
 
+        if self.event_mode:
+            self.baseline = (self.clock(), self.is_wet())
+            GPIO.add_event_detect(self.sensor_pin, GPIO.BOTH, callback=self._on_edge, bouncetime=self.bouncetime_ms)
+
+    def is_wet(self) -> bool:
+        # The sensor pulls the pin low when the soil is wet
+        return GPIO.input(self.sensor_pin) == GPIO.LOW
+
+    def _on_edge(self, channel) -> None:
+        # Runs on the GPIO library's callback thread, only records the change
+        now = self.clock()
+        wet = self.is_wet()
+        with self.lock:
+            if wet == self.current_state():
+                # A bounce that settled back where it started
+                return
+            self._record(now, wet)
+        metrics.increment('moisture_transitions_total', sensor_pin=self.sensor_pin)
+
+    def _record(self, at, wet) -> None:
+        # Called with the lock held
+        if len(self.transitions) >= self.max_transitions:
+            self.baseline = self.transitions.popleft()
+        self.transitions.append((at, wet))
+
+    def current_state(self) -> bool:
+        return self.transitions[-1][1] if self.transitions else self.baseline[1]
+
     def get_moisture_reading(self) -> int:
         # Returns a 1 if the soil is wet
         # Returns a 0 if the soil is dry
+        wet = self.is_wet()
+        if self.event_mode:
+            # The pin is the truth, a lost settling edge would otherwise leave the recorded state wrong
+            # until the next real transition
+            now = self.clock()
+            with self.lock:
+                missed = wet != self.current_state()
+                if missed:
+                    self._record(now, wet)
+            if missed:
+                metrics.increment('moisture_missed_edges_total', sensor_pin=self.sensor_pin)
+                logger.warning("Moisture pin %s reads %s but no edge was recorded, state corrected",
+                               self.sensor_pin, "wet" if wet else "dry")
 
-        if GPIO.input(self.sensor_pin) == GPIO.LOW:
-            print("Soil is wet")
+        if wet:
+            logger.debug("Soil is wet")
             return 1
         else:
-            print("Soil is dry")
+            logger.debug("Soil is dry")
             return 0
+
+    def get_transitions(self, start=None, end=None) -> list:
+        # (time, wet) changes within the window, e.g. the moments the plant was watered
+        with self.lock:
+            return [(at, wet) for at, wet in self.transitions
+                    if (start is None or at >= start) and (end is None or at <= end)]
+
+    def moisture_fractions(self, start, end=None) -> dict:
+        # Share of the window the soil spent wet and dry. coverage is the share of the window the
+        # history still reaches back to, the fractions only describe that part
+        if not self.event_mode:
+            raise RuntimeError("moisture fractions need event_mode=True")
+
+        end = self.clock() if end is None else end
+        with self.lock:
+            history = [self.baseline] + list(self.transitions)
+
+        covered_start = max(start, history[0][0])
+        wet_seconds = 0.0
+        for i, (at, wet) in enumerate(history):
+            # Each state lasts until the next transition, or the end of the window
+            until = history[i + 1][0] if i + 1 < len(history) else end
+            overlap = min(until, end) - max(at, covered_start)
+            if wet and overlap > 0:
+                wet_seconds += overlap
+
+        covered = max(end - covered_start, 0.0)
+        wet_fraction = wet_seconds / covered if covered > 0 else float(history[-1][1])
+        return {
+            'wet': wet_fraction,
+            'dry': 1.0 - wet_fraction,
+            'transitions': sum(1 for at, _ in history[1:] if start <= at <= end),
+            'coverage': covered / (end - start) if end > start else 1.0,
+        }
+
+    def close(self) -> None:
+        if self.event_mode:
+            GPIO.remove_event_detect(self.sensor_pin)
@@ -1,14 +1,76 @@
+import logging
+import statistics
+import threading
+
 import RPi.GPIO as GPIO
 
+# Kernel SPI driver, optional: without it the MCP3008 is bit-banged over GPIO
+try:
+    import spidev
+except ImportError:
+    spidev = None
+
+logger = logging.getLogger(__name__)
+
+# How a burst of samples is reduced to one reading
+FILTER_MEDIAN = 'median'
+FILTER_TRIMMED_MEAN = 'trimmed_mean'
+
+# Every Ph instance talks to the same MCP3008, stations reading different channels take turns on the bus
+BUS_LOCK = threading.Lock()
+
+# Samples per reading unless given. An SPI conversion is a single short transfer. A bit-banged one is
+# about 60 GPIO calls with the bus lock held, so the burst is kept just big enough for the median to reject
+# a couple of spikes. Benchmark.py reports the noise and bus hold time of both
+SPI_SAMPLES = 16
+BITBANG_SAMPLES = 5
+
 
 class Ph:
-    def __init__(self):
+    def __init__(self, channel=0, samples=None, sample_filter=FILTER_MEDIAN, trim=0.2, use_spi=False, spi_bus=0,
+                 spi_device=0, spi_speed_hz=1350000, spi=None):
         self.clk_pin = 17  # SPI Clock (Pin 11)
         self.miso_pin = 27  # SPI MISO (Pin 13)
         self.mosi_pin = 22  # SPI MOSI (Pin 15)
         self.cs_pin = 26  # SPI CS (Pin 37)
 
-        self.setup()
+        self.channel = channel
+        self.sample_filter = sample_filter
+        # Fraction of samples dropped at each end for the trimmed mean, half or more would drop them all
+        if not 0 <= trim < 0.5:
+            raise ValueError("trim must be at least 0 and less than 0.5")
+        self.trim = trim
+
+        # Hardware SPI uses the SPI0 pins (GPIO 8-11), not the bit-bang pins above,
+        # so it is opt-in for boards wired to the kernel SPI bus.
+        # An already opened SPI device can be passed in, e.g. a fake one for testing
+        self.spi = spi
+        if self.spi is None and use_spi:
+            self.spi = self.open_spi(spi_bus, spi_device, spi_speed_hz)
+
+        if self.spi is None:
+            self.setup()
+
+        # Every reading is the filtered result of a burst of this many samples
+        if samples is None:
+            samples = SPI_SAMPLES if self.spi is not None else BITBANG_SAMPLES
+        self.samples = samples
+
+    @staticmethod
+    def open_spi(bus, device, speed_hz):
+        if spidev is None:
+            logger.info("spidev not available, bit-banging the ADC over GPIO")
+            return None
+
+        try:
+            spi = spidev.SpiDev()
+            spi.open(bus, device)
+            spi.max_speed_hz = speed_hz
+            spi.mode = 0
+            return spi
+        except OSError as e:
+            logger.warning("SPI device %s.%s not available (%s), bit-banging the ADC over GPIO", bus, device, e)
+            return None
 
     def setup(self):
         # Setup GPIO
@@ -19,18 +81,45 @@ class Ph:
         GPIO.setup(self.cs_pin, GPIO.OUT)
 
     def get_ph_reading(self):
-        adc_val = self.read_adc(0)
+        adc_val = self.read_channels([self.channel])[self.channel]
         voltage = self.adc_to_voltage(adc_val)
         ph = self.voltage_to_ph(voltage)
 
-        # Print for logging
-        print(f"ADC: {adc_val} | Voltage: {voltage:.2f} V | pH: {ph:.2f}")
+        logger.debug("ADC: %.1f | Voltage: %.2f V | pH: %.2f", adc_val, voltage, ph)
         return ph
 
+    def read_channels(self, channels, samples=None) -> dict:
+        # Burst-samples every channel in one scan and filters each burst down to a single value
+        samples = samples or self.samples
+        bursts = {channel: [] for channel in channels}
+        with BUS_LOCK:
+            for _ in range(samples):
+                for channel in channels:
+                    bursts[channel].append(self.read_adc(channel))
+
+        return {channel: self.filter_samples(values) for channel, values in bursts.items()}
+
+    def filter_samples(self, values) -> float:
+        if len(values) == 1:
+            return float(values[0])
+        if self.sample_filter == FILTER_TRIMMED_MEAN:
+            values = sorted(values)
+            cut = int(len(values) * self.trim)
+            return float(statistics.fmean(values[cut:len(values) - cut]))
+        return float(statistics.median(values))
+
     def read_adc(self, channel):
         if channel < 0 or channel > 7:
             return -1
 
+        if self.spi is not None:
+            # Start bit, single-ended + channel, then clock out the 10-bit result
+            reply = self.spi.xfer2([1, (8 + channel) << 4, 0])
+            return ((reply[1] & 0x03) << 8) | reply[2]
+
+        return self.read_adc_bitbang(channel)
+
+    def read_adc_bitbang(self, channel):
         GPIO.output(self.cs_pin, True)
         GPIO.output(self.clk_pin, False)
         GPIO.output(self.cs_pin, False)
@@ -67,3 +156,7 @@ class Ph:
         volts_per_ph = 0.18
         ph = 7.0 + (voltage_at_ph7 - voltage) / volts_per_ph
         return float(ph)
+
+    def close(self):
+        if self.spi is not None:
+            self.spi.close()
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import logging
+import math
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+import cv2
+import numpy as np
+
+from ColumnStore import ENTRY_KEYS, MISSING_INT
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Entry fields kept in the cache and served to clients, in the order the CSV stores them
+FIELDS = ('timestamp', 'ph', 'temperature', 'moisture', 'humidity', 'yellowing', 'image_name', 'station')
+NUMERIC_FIELDS = ('ph', 'temperature', 'moisture', 'humidity', 'yellowing')
+
+# Column store column for each numeric field
+STORE_COLUMNS = {field: column for column, field in ENTRY_KEYS.items()}
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def downsample(timestamps, columns, start_ms, end_ms, points) -> list:
+    # Averages every numeric column over points equal time buckets, empty buckets are left out.
+    # Yellowing is the bucket's maximum so a single detection is never averaged away
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    # Rows outside the range would otherwise be clamped into the first or last bucket
+    inside = (timestamps >= start_ms) & (timestamps <= end_ms)
+    if not inside.all():
+        timestamps = timestamps[inside]
+        columns = {name: np.asarray(values)[inside] for name, values in columns.items()}
+    if len(timestamps) == 0:
+        return []
+
+    width = max((end_ms - start_ms + 1) / points, 1)
+    buckets = np.minimum(((timestamps - start_ms) / width).astype(np.int64), points - 1)
+    occupied, inverse, counts = np.unique(buckets, return_inverse=True, return_counts=True)
+
+    result = {'timestamp': (start_ms + (occupied + 0.5) * width).astype(np.int64).tolist(), 'count': counts.tolist()}
+    for name, values in columns.items():
+        values = np.asarray(values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        if name == 'yellowing':
+            maximum = np.full(len(occupied), -np.inf)
+            np.maximum.at(maximum, inverse[valid], values[valid])
+            result[name] = [None if math.isinf(value) else value for value in maximum.tolist()]
+        else:
+            sums = np.bincount(inverse[valid], weights=values[valid], minlength=len(occupied))
+            sizes = np.bincount(inverse[valid], minlength=len(occupied))
+            result[name] = [None if size == 0 else total / size for total, size in zip(sums.tolist(), sizes.tolist())]
+
+    return [dict(zip(result, row)) for row in zip(*result.values())]
+
+
+class LiveCache:
+    def __init__(self, history_size=8640, column_store=None, jpeg_quality=80):
+        # Recent entries per station, a day at the default 10 second interval
+        self.history_size = history_size
+        # Optional ColumnStore for ranges older than the cached history, the CSV is never read
+        self.column_store = column_store
+        self.jpeg_quality = jpeg_quality
+
+        self.lock = threading.Lock()
+        self.history = {}
+        self.latest = {}
+        self.images = {}
+
+        # Bumped on every update, cached responses from an older version are rebuilt
+        self.version = 0
+        self.responses = {}
+
+    def update(self, entry) -> None:
+        # Called by the monitor after every sample, keeps only the served fields
+        row = {field: entry.get(field) for field in FIELDS}
+        with self.lock:
+            station = row['station']
+            if station not in self.history:
+                self.history[station] = deque(maxlen=self.history_size)
+            self.history[station].append(row)
+            self.latest[station] = row
+            self.version += 1
+            self.responses.clear()
+
+    def update_image(self, filename, frame, yellowing=None, station=None) -> None:
+        # Keeps a reference to the frame, it is only encoded once the first client asks for it
+        with self.lock:
+            self.images[station] = {'filename': filename, 'frame': frame, 'yellowing': yellowing, 'jpeg': None}
+
+    def latest_image(self, station=None):
+        with self.lock:
+            image = self.images.get(station)
+            if image is None:
+                return None
+            if image['jpeg'] is None:
+                ok, encoded = cv2.imencode('.jpg', image['frame'], [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                if not ok:
+                    return None
+                image['jpeg'] = encoded.tobytes()
+                # The encoded copy is all that's needed from now on
+                image['frame'] = None
+            return image['filename'], image['jpeg']
+
+    def cached_response(self, key, build):
+        # Many clients polling the same thing between samples share one response
+        with self.lock:
+            version = self.version
+            response = self.responses.get(key)
+        if response is not None:
+            return response
+
+        response = build()
+        with self.lock:
+            if self.version == version:
+                self.responses[key] = response
+        return response
+
+    def get_latest(self, station=None):
+        with self.lock:
+            return self.latest.get(station)
+
+    def get_history(self, start_ms=None, end_ms=None, points=None, station=None) -> list:
+        with self.lock:
+            rows = list(self.history.get(station, ()))
+
+        oldest_cached = rows[0]['timestamp'] if rows else None
+        rows = [row for row in rows
+                if (start_ms is None or row['timestamp'] >= start_ms) and (end_ms is None or row['timestamp'] <= end_ms)]
+
+        timestamps = np.array([row['timestamp'] for row in rows], dtype=np.int64)
+        columns = {name: np.array([np.nan if row[name] is None else row[name] for row in rows], dtype=np.float64)
+                   for name in NUMERIC_FIELDS}
+
+        if self.column_store is not None and start_ms is not None \
+                and (oldest_cached is None or start_ms < oldest_cached):
+            # Older than the cache reaches back, that part comes from the memory-mapped column store
+            stored_end = end_ms
+            if oldest_cached is not None:
+                stored_end = oldest_cached - 1 if end_ms is None else min(end_ms, oldest_cached - 1)
+            stored_timestamps, stored = self.store_columns(start_ms, stored_end, station)
+            timestamps = np.concatenate([stored_timestamps, timestamps])
+            columns = {name: np.concatenate([stored[name], columns[name]]) for name in NUMERIC_FIELDS}
+        elif not points or len(rows) <= points:
+            return rows
+
+        if not points or len(timestamps) <= points:
+            result = [{'timestamp': timestamp} for timestamp in timestamps.tolist()]
+            for name, values in columns.items():
+                for row, value in zip(result, values.tolist()):
+                    row[name] = None if math.isnan(value) else value
+            return result
+
+        return downsample(timestamps, columns,
+                          int(timestamps[0]) if start_ms is None else start_ms,
+                          int(timestamps[-1]) if end_ms is None else end_ms, points)
+
+    def store_columns(self, start_ms, end_ms, station=None):
+        data = self.column_store.load(start_ms, end_ms, ['timestamp'] + [STORE_COLUMNS.get(name, name)
+                                                                         for name in NUMERIC_FIELDS], station=station)
+        columns = {}
+        for name in NUMERIC_FIELDS:
+            stored = data[STORE_COLUMNS.get(name, name)]
+            values = stored.astype(np.float64)
+            if stored.dtype.kind == 'i':
+                values[stored == MISSING_INT] = np.nan
+            columns[name] = values
+        return np.asarray(data['timestamp'], dtype=np.int64), columns
+
+
+class QueryServer:
+    def __init__(self, live_cache, host='127.0.0.1', port=8080, unix_socket=None, max_points=2000):
+        self.live_cache = live_cache
+        self.host = host
+        self.port = port
+        # Serve on a Unix socket instead of TCP when a path is given
+        self.unix_socket = unix_socket
+        # Upper limit on the points a history request may ask for
+        self.max_points = max_points
+
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.started = threading.Event()
+
+    def start(self) -> None:
+        # The server gets its own event loop on a background thread, the monitor loop is never blocked
+        self.thread = threading.Thread(target=self._run, name="QueryServer", daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def _run(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if self.unix_socket:
+                self.server = self.loop.run_until_complete(
+                    asyncio.start_unix_server(self.handle, path=self.unix_socket))
+                logger.info("Query server listening on %s", self.unix_socket)
+            else:
+                self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+                # Port 0 picks a free port, report the real one
+                self.port = self.server.sockets[0].getsockname()[1]
+                logger.info("Query server listening on http://%s:%s", self.host, self.port)
+        except OSError:
+            logger.exception("Query server could not start")
+            self.started.set()
+            return
+
+        self.started.set()
+        self.loop.run_forever()
+
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    async def handle(self, reader, writer) -> None:
+        try:
+            request_line = await reader.readline()
+            # Headers are read and ignored, every response closes the connection
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2:
+                status, content_type, body = 400, 'application/json', b'{"error": "bad request"}'
+            elif parts[0] != 'GET':
+                status, content_type, body = 405, 'application/json', b'{"error": "only GET is supported"}'
+            else:
+                with metrics.span('query'):
+                    status, content_type, body = await self.route(parts[1])
+
+            writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n"
+                         .encode('latin-1') + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, target):
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        station = query.get('station')
+
+        try:
+            if url.path == '/latest':
+                body = self.live_cache.cached_response(('latest', station), lambda: json.dumps(
+                    self.live_cache.get_latest(station)).encode())
+                return 200, 'application/json', body
+
+            if url.path == '/history':
+                start_ms = int(query['start']) if 'start' in query else None
+                end_ms = int(query['end']) if 'end' in query else None
+                points = min(int(query.get('points', self.max_points)), self.max_points)
+                if points < 1:
+                    raise ValueError("points must be positive")
+
+                def build():
+                    return json.dumps(self.live_cache.get_history(start_ms, end_ms, points, station)).encode()
+
+                # Downsampling a long range can take a while, keep it off the event loop
+                body = await self.loop.run_in_executor(
+                    None, self.live_cache.cached_response, ('history', start_ms, end_ms, points, station), build)
+                return 200, 'application/json', body
+
+            if url.path in ('/image/latest', '/image/latest.jpg'):
+                image = await self.loop.run_in_executor(None, self.live_cache.latest_image, station)
+                if image is None:
+                    return 404, 'application/json', b'{"error": "no image yet"}'
+                return 200, 'image/jpeg', image[1]
+        except ValueError as e:
+            return 400, 'application/json', json.dumps({'error': str(e)}).encode()
+        except Exception:
+            logger.exception("Query %s failed", target)
+            return 500, 'application/json', b'{"error": "internal error"}'
+
+        return 404, 'application/json', b'{"error": "not found"}'
+
+    def close(self) -> None:
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join()
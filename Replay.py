@@ -0,0 +1,239 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import FakeHardware
+
+# Replays must never drive the real LED, GPIO and the DHT sensor are replaced before anything imports them
+FakeHardware.install()
+
+import cv2
+
+from DataHandler import DataHandler
+from HealthModel import HealthModel
+from ImageLifecycle import shard_folder
+from Scheduler import FixedRateScheduler, CATCH_UP
+from SensorReader import OK, MISSING
+from YellowDetector import YellowDetector
+from main import MonitoringSystem
+
+
+class VirtualClock:
+    def __init__(self, start, speedup=None):
+        # Seconds since the epoch, only moves when the scheduler sleeps
+        self.now = start
+        # None replays as fast as possible, otherwise virtual seconds per real second
+        self.speedup = speedup
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds) -> None:
+        if seconds > 0:
+            self.now += seconds
+            if self.speedup:
+                time.sleep(seconds / self.speedup)
+
+
+class RecordedSensors:
+    # Serves the readings of the row being replayed through the real sensor interfaces
+    def __init__(self):
+        self.row = None
+
+    def get_reading(self) -> dict:
+        if self.row['temperature'] is None or self.row['humidity'] is None:
+            raise Exception("Invalid Sensor Reading")
+        return {'temperature': self.row['temperature'], 'humidity': self.row['humidity']}
+
+    def get_moisture_reading(self):
+        if self.row['soil_moisture'] is None:
+            raise Exception("Invalid Sensor Reading")
+        return int(self.row['soil_moisture'])
+
+    def get_ph_reading(self):
+        if self.row['ph'] is None:
+            raise Exception("Invalid Sensor Reading")
+        return self.row['ph']
+
+
+class DirectSensorReader:
+    # Recorded readings never block, so they are read inline instead of on a thread pool
+    def __init__(self):
+        self.sensors = {}
+
+    def add_sensor(self, name, read_function, timeout) -> None:
+        self.sensors[name] = read_function
+
+    def read_all(self):
+        values = {}
+        status = {}
+        for name, read_function in self.sensors.items():
+            try:
+                values[name], status[name] = read_function(), OK
+            except Exception:
+                values[name], status[name] = None, MISSING
+        return values, status
+
+    def close(self) -> None:
+        pass
+
+
+class ReplayMonitoringSystem(MonitoringSystem):
+    def __init__(self, rows, image_folders, **kwargs):
+        self.rows = rows
+        self.image_folders = image_folders
+        self.sensors = RecordedSensors()
+        self.row = None
+
+        # Recorded rows share a photo until the next one is taken, it is only analysed once
+        self.last_image = None
+        self.differences = []
+        self.cycles = 0
+
+        super().__init__(camera=None, moisture=self.sensors, temp_humidity=self.sensors, ph=self.sensors,
+                         **kwargs)
+
+        self.sensor_reader.close()
+        self.sensor_reader = DirectSensorReader()
+        self.sensor_reader.add_sensor('temp_humidity', self.sensors.get_reading, 0)
+        self.sensor_reader.add_sensor('moisture', self.sensors.get_moisture_reading, 0)
+        self.sensor_reader.add_sensor('ph', self.sensors.get_ph_reading, 0)
+
+        self.next_row()
+
+    def next_row(self) -> None:
+        self.row = next(self.rows, None)
+        self.sensors.row = self.row
+        if self.row is None:
+            # History exhausted, end the replay
+            self.scheduler.stop()
+
+    def find_image(self, image_path):
+        if os.path.exists(image_path):
+            return image_path
+
+        filename = os.path.basename(image_path)
+        for folder in self.image_folders:
+            # Flat layout first, then the date shard the lifecycle manager moves images into
+            for path in (os.path.join(folder, filename), os.path.join(shard_folder(folder, filename), filename)):
+                if os.path.exists(path):
+                    return path
+        return None
+
+    def capture(self):
+        image_path = self.row['image_filepath']
+        if image_path == self.last_image and self.latest_image is not None:
+            return
+        self.last_image = image_path
+
+        path = self.find_image(image_path) if image_path else None
+        frame = cv2.imread(path) if path else None
+        if frame is None:
+            # No saved image to re-analyse, carry the recorded result through
+            recorded = self.row['yellowing']
+            self.latest_image = image_path or None
+            self.latest_yellowing = None if recorded is None else int(recorded)
+            return
+
+        self.analyse_image(image_path, frame)
+
+    def entry_timestamp(self):
+        # Keep the recorded timestamp so the output lines up with the input
+        return self.row['timestamp']
+
+    def sample(self):
+        entry = super().sample()
+        self.cycles += 1
+
+        recorded = self.row['yellowing']
+        if recorded is not None and entry['yellowing'] != int(recorded):
+            self.differences.append({
+                'timestamp': entry['timestamp'],
+                'image': entry['image_name'],
+                'recorded_yellowing': int(recorded),
+                'replayed_yellowing': entry['yellowing'],
+            })
+
+        self.next_row()
+        return entry
+
+
+def replay(start_ms=None, end_ms=None, interval=10, speedup=None, output_folder='replay_data', verbose=False):
+    source = DataHandler(read_only=True)
+    rows = source.query(start_ms, end_ms)
+
+    first = next(rows, None)
+    if first is None:
+        print("No recorded readings in range")
+        return None
+
+    def all_rows():
+        yield first
+        yield from rows
+
+    clock = VirtualClock(first['timestamp'] / 1000 - interval, speedup=speedup)
+    # The virtual clock never overruns, catch_up keeps one cycle per recorded row regardless.
+    # Cycles start on the first grid slot, so each replays the recorded row taken at that time
+    scheduler = FixedRateScheduler(clock=clock.monotonic, wall_clock=clock.time, sleep=clock.sleep,
+                                   run_immediately=False)
+
+    output = DataHandler(data_folder=output_folder, flush_rows=1000)
+    monitoring_system = ReplayMonitoringSystem(
+        rows=all_rows(),
+        image_folders=['unprocessed_images', 'processed_images'],
+        data_handler=output,
+        yellow_detector=YellowDetector(),
+        health_model=HealthModel(),
+        interval=interval,
+        scheduler=scheduler,
+        overrun_policy=CATCH_UP,
+        alert_duration=0
+    )
+
+    start = time.perf_counter()
+    if not verbose:
+        # Per-cycle logging would dominate the replay time
+        logging.disable(logging.WARNING)
+    try:
+        monitoring_system.monitor()
+    finally:
+        logging.disable(logging.NOTSET)
+        monitoring_system.alert_scheduler.close()
+        output.close()
+        source.close()
+    elapsed = time.perf_counter() - start
+
+    report = {
+        'cycles': monitoring_system.cycles,
+        'elapsed_s': elapsed,
+        'cycles_per_s': monitoring_system.cycles / elapsed if elapsed > 0 else 0.0,
+        'differences': len(monitoring_system.differences),
+        'first_differences': monitoring_system.differences[:20],
+    }
+    print(f"Replayed {report['cycles']} cycles in {elapsed:.1f}s ({report['cycles_per_s']:.0f} cycles/s), "
+          f"{report['differences']} yellowing result(s) differ")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded readings and images through the monitoring system")
+    parser.add_argument('--start-ms', type=int, default=None)
+    parser.add_argument('--end-ms', type=int, default=None)
+    parser.add_argument('--interval', type=float, default=10, help="seconds between recorded readings")
+    parser.add_argument('--speedup', type=float, default=None, help="virtual seconds per real second, default is as fast as possible")
+    parser.add_argument('--output-folder', default='replay_data')
+    parser.add_argument('--report', default=None, help="save the report as JSON")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    result = replay(args.start_ms, args.end_ms, args.interval, args.speedup, args.output_folder, args.verbose)
+    if result is not None and args.report:
+        with open(args.report, 'w') as file:
+            json.dump(result, file, indent=2)
@@ -0,0 +1,113 @@
+import math
+from collections import deque
+
+import numpy as np
+
+# Readings tracked by default, the same inputs the health model uses
+COLUMNS = ('temperature', 'humidity', 'moisture', 'ph')
+
+# Statistics kept for every column, in feature order
+STATS = ('mean', 'min', 'max', 'var', 'ewma')
+
+
+def feature_names(columns=COLUMNS) -> list:
+    # e.g. temperature_mean, temperature_min, ... ph_ewma
+    return [f"{column}_{stat}" for column in columns for stat in STATS]
+
+
+class RollingWindow:
+    def __init__(self, size, columns=COLUMNS, alpha=None):
+        if size < 1:
+            raise ValueError("size must be at least 1")
+        self.size = size
+        self.columns = list(columns)
+        # Same centre of mass as a simple average over the window unless given
+        self.alpha = alpha if alpha is not None else 2 / (size + 1)
+
+        # Fixed ring of the last size readings, NaN marks a missing reading
+        self.buffer = np.full((size, len(self.columns)), np.nan)
+        self.pushed = 0
+
+        # Running totals over the valid readings in the ring, updated on every push and eviction
+        self.count = [0] * len(self.columns)
+        self.sum = [0.0] * len(self.columns)
+        self.sum_squares = [0.0] * len(self.columns)
+        self.ewma = [math.nan] * len(self.columns)
+
+        # Monotonic deques of (push number, value): the front is always the window's min or max
+        self.minimums = [deque() for _ in self.columns]
+        self.maximums = [deque() for _ in self.columns]
+
+    def __len__(self) -> int:
+        return min(self.pushed, self.size)
+
+    def push(self, readings) -> dict:
+        # Adds one reading per column (a dict, missing keys or None count as missing) and returns the features
+        slot = self.pushed % self.size
+        oldest = self.pushed - self.size  # push number that drops out of the window
+
+        for i, column in enumerate(self.columns):
+            value = readings.get(column)
+            value = math.nan if value is None else float(value)
+
+            evicted = self.buffer[slot, i]
+            if not math.isnan(evicted):
+                self.count[i] -= 1
+                self.sum[i] -= evicted
+                self.sum_squares[i] -= evicted * evicted
+            self.buffer[slot, i] = value
+
+            minimums, maximums = self.minimums[i], self.maximums[i]
+            while minimums and minimums[0][0] <= oldest:
+                minimums.popleft()
+            while maximums and maximums[0][0] <= oldest:
+                maximums.popleft()
+
+            if not math.isnan(value):
+                self.count[i] += 1
+                self.sum[i] += value
+                self.sum_squares[i] += value * value
+                self.ewma[i] = value if math.isnan(self.ewma[i]) else \
+                    self.alpha * value + (1 - self.alpha) * self.ewma[i]
+
+                while minimums and minimums[-1][1] >= value:
+                    minimums.pop()
+                minimums.append((self.pushed, value))
+                while maximums and maximums[-1][1] <= value:
+                    maximums.pop()
+                maximums.append((self.pushed, value))
+
+        self.pushed += 1
+        if self.pushed % self.size == 0:
+            # Adding and removing values lets rounding errors build up, start the totals afresh once per lap
+            valid = ~np.isnan(self.buffer)
+            self.count = valid.sum(axis=0).tolist()
+            self.sum = np.nansum(self.buffer, axis=0).tolist()
+            self.sum_squares = np.nansum(self.buffer * self.buffer, axis=0).tolist()
+
+        return self.features()
+
+    def features(self) -> dict:
+        features = {}
+        for i, column in enumerate(self.columns):
+            count = self.count[i]
+            if count:
+                mean = self.sum[i] / count
+                variance = max(self.sum_squares[i] / count - mean * mean, 0.0)
+                minimum, maximum = self.minimums[i][0][1], self.maximums[i][0][1]
+            else:
+                mean = variance = minimum = maximum = math.nan
+
+            features[f"{column}_mean"] = mean
+            features[f"{column}_min"] = minimum
+            features[f"{column}_max"] = maximum
+            features[f"{column}_var"] = variance
+            features[f"{column}_ewma"] = self.ewma[i]
+        return features
+
+    def values(self):
+        # Readings in the window, oldest first
+        if self.pushed <= self.size:
+            return self.buffer[:self.pushed].copy()
+        slot = self.pushed % self.size
+        return np.concatenate([self.buffer[slot:], self.buffer[:slot]])
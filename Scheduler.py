@@ -0,0 +1,136 @@
+import heapq
+import logging
+import math
+import threading
+import time
+
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# What to do with slots that were missed because a run overran its period
+SKIP = 'skip'  # drop every missed slot and wait for the next one on the grid
+RUN_LATE = 'run_late'  # run once straight away, then carry on from the grid
+CATCH_UP = 'catch_up'  # run every missed slot back to back
+
+
+class ScheduledTask:
+    def __init__(self, name, function, period, policy=SKIP, offset=0.0):
+        self.name = name
+        self.function = function
+        self.period = period
+        self.policy = policy
+        # Shift from the wall-clock grid, e.g. 30 to run half a minute past each minute
+        self.offset = offset
+
+        self.next_due = None
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.max_lateness = 0.0
+
+
+class FixedRateScheduler:
+    def __init__(self, clock=time.monotonic, wall_clock=time.time, sleep=None, run_immediately=True):
+        # Run times are tracked on the monotonic clock, the wall clock is only used to pick the grid
+        self.clock = clock
+        self.wall_clock = wall_clock
+        # Run every task once on start, then follow the grid. Otherwise a daily task would do nothing
+        # until its first slot, midnight UTC
+        self.run_immediately = run_immediately
+
+        self.tasks = []
+        self.stop_event = threading.Event()
+
+        # By default wait on the stop event so stop() wakes the loop up
+        self.sleep = sleep or self.stop_event.wait
+
+    def add_task(self, name, function, period, policy=SKIP, offset=0.0) -> ScheduledTask:
+        if policy not in (SKIP, RUN_LATE, CATCH_UP):
+            raise ValueError(f"Unknown overrun policy: {policy}")
+        if period <= 0:
+            raise ValueError("period must be positive")
+
+        task = ScheduledTask(name, function, period, policy, offset)
+        self.tasks.append(task)
+        return task
+
+    def _first_due(self, task) -> float:
+        # Align the first run to the next multiple of the period on the wall clock
+        wall_now = self.wall_clock()
+        wall_due = math.ceil((wall_now - task.offset) / task.period) * task.period + task.offset
+        return self.clock() + (wall_due - wall_now)
+
+    def run(self) -> None:
+        heap = []
+        now = self.clock()
+        for order, task in enumerate(self.tasks):
+            task.next_due = self._first_due(task)
+            wall_due = self.wall_clock() + task.next_due - now
+            logger.info("Task %s runs every %ss on the grid from %s", task.name, task.period,
+                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(wall_due)))
+
+            # Tasks due at the same time run in the order they were added
+            first_run = min(now, task.next_due) if self.run_immediately else task.next_due
+            heapq.heappush(heap, (first_run, order, task))
+
+        while heap and not self.stop_event.is_set():
+            due, order, task = heapq.heappop(heap)
+
+            delay = due - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+            if self.stop_event.is_set():
+                break
+
+            lateness = self.clock() - due
+            task.max_lateness = max(task.max_lateness, lateness)
+            metrics.observe('schedule_lateness_seconds', max(lateness, 0.0), task=task.name)
+            try:
+                task.function()
+            except Exception:
+                task.errors += 1
+                logger.exception("Task %s failed", task.name)
+            task.runs += 1
+
+            # After an immediate first run the task's first grid slot is still to come
+            if due >= task.next_due:
+                task.next_due = self._next_due(task, due)
+            heapq.heappush(heap, (task.next_due, order, task))
+
+    def _next_due(self, task, due) -> float:
+        # Always step from the scheduled time, not from when the run finished, so the period never drifts
+        next_due = due + task.period
+        now = self.clock()
+        if now <= next_due:
+            return next_due
+
+        missed = int((now - next_due) // task.period) + 1
+        task.overruns += 1
+        metrics.increment('schedule_missed_slots_total', missed, task=task.name)
+        logger.warning("Task %s overran its %ss period, %s slot(s) missed", task.name, task.period, missed)
+
+        if task.policy == SKIP:
+            task.skipped += missed
+            return next_due + missed * task.period
+        if task.policy == RUN_LATE:
+            task.skipped += missed - 1
+            return next_due + (missed - 1) * task.period
+        return next_due
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def stats(self) -> dict:
+        return {
+            task.name: {
+                'period': task.period,
+                'runs': task.runs,
+                'overruns': task.overruns,
+                'skipped': task.skipped,
+                'errors': task.errors,
+                'max_lateness': task.max_lateness,
+            }
+            for task in self.tasks
+        }
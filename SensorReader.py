@@ -0,0 +1,91 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from Metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Reading status values
+OK = 'ok'
+STALE = 'stale'
+MISSING = 'missing'
+
+
+class SensorReader:
+    def __init__(self, max_stale_age=300.0, executor=None):
+        # Readings older than this (seconds) are reported as missing instead of stale
+        self.max_stale_age = max_stale_age
+
+        # name -> (read function, timeout in seconds)
+        self.sensors = {}
+
+        # name -> future of a read that is still running
+        self.in_flight = {}
+
+        # name -> (value, monotonic time of the reading)
+        self.last_good = {}
+
+        self.executor = executor or ThreadPoolExecutor(thread_name_prefix="SensorReader")
+        self.owns_executor = executor is None
+
+    def add_sensor(self, name: str, read_function, timeout: float) -> None:
+        self.sensors[name] = (read_function, timeout)
+
+    def read_all(self):
+        # Start every sensor read at once
+        started = time.monotonic()
+        for name, (read_function, _) in self.sensors.items():
+            # A read that overran its deadline last cycle may still be blocked,
+            # don't pile another call on top of it
+            if name not in self.in_flight:
+                self.in_flight[name] = self.executor.submit(self._timed_read, name, read_function)
+
+        # Wait at most until the slowest deadline
+        longest_timeout = max((timeout for _, timeout in self.sensors.values()), default=0)
+        wait(list(self.in_flight.values()), timeout=longest_timeout)
+
+        values = {}
+        status = {}
+        for name, (_, timeout) in self.sensors.items():
+            future = self.in_flight[name]
+
+            if future.done():
+                del self.in_flight[name]
+                try:
+                    value, finished_at = future.result()
+                except Exception as e:
+                    metrics.increment('sensor_failures_total', sensor=name)
+                    logger.warning("%s sensor read failed: %s", name, e)
+                else:
+                    self.last_good[name] = (value, finished_at)
+                    if finished_at - started <= timeout:
+                        values[name] = value
+                        status[name] = OK
+                        continue
+            else:
+                metrics.increment('sensor_timeouts_total', sensor=name)
+                logger.warning("%s sensor read timed out after %ss", name, timeout)
+
+            values[name], status[name] = self._fallback(name)
+            metrics.increment('sensor_fallbacks_total', sensor=name, status=status[name])
+
+        return values, status
+
+    @staticmethod
+    def _timed_read(name, read_function):
+        with metrics.span('sensor_read', sensor=name):
+            value = read_function()
+        return value, time.monotonic()
+
+    def _fallback(self, name: str):
+        # Use the last good value if it's recent enough, otherwise report it missing
+        if name in self.last_good:
+            value, read_at = self.last_good[name]
+            if time.monotonic() - read_at <= self.max_stale_age:
+                return value, STALE
+        return None, MISSING
+
+    def close(self) -> None:
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
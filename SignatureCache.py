@@ -0,0 +1,227 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+
+from YellowDetector import YellowDetector
+
+logger = logging.getLogger(__name__)
+
+
+class SignatureCache:
+    def __init__(self, detector=None, database='data/signatures.sqlite', bin_width=8, hash_content=False):
+        self.detector = detector or YellowDetector()
+        self.database = database
+        self.bin_width = bin_width
+        # Hashing every file finds images that were moved or touched but costs a full read per changed file
+        self.hash_content = hash_content
+
+        folder = os.path.dirname(self.database)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.connection = sqlite3.connect(self.database)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS signatures ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT, signature BLOB)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS signatures_digest ON signatures (digest)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        self.check_settings()
+
+    def settings(self) -> str:
+        # Signatures are only comparable when they were computed the same way
+        return json.dumps({'bin_width': self.bin_width, 'reduction': self.detector.reduction,
+                           'roi': self.detector.roi})
+
+    def check_settings(self) -> None:
+        row = self.connection.execute("SELECT value FROM settings WHERE key = 'signature'").fetchone()
+        if row is not None and row[0] == self.settings():
+            return
+
+        if row is not None:
+            logger.info("Signature settings changed, clearing the signature cache.")
+        with self.connection:
+            self.connection.execute("DELETE FROM signatures")
+            self.connection.execute("INSERT OR REPLACE INTO settings VALUES ('signature', ?)", (self.settings(),))
+
+    @staticmethod
+    def file_digest(path) -> str:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def pack(signature) -> bytes:
+        # Most bins of a leaf photo are empty, only the occupied ones are kept
+        flat = signature.ravel()
+        indices = np.flatnonzero(flat).astype('<u4')
+        counts = flat[indices].astype('<u4')
+        return zlib.compress(indices.tobytes() + counts.tobytes())
+
+    @staticmethod
+    def unpack(blob):
+        # Returns the (bin indices, pixel counts) of an occupied signature
+        data = np.frombuffer(zlib.decompress(blob), dtype='<u4')
+        half = len(data) // 2
+        return data[:half], data[half:]
+
+    def _lookup(self, path):
+        # Returns (cached signature or None, values to store if the signature has to be computed)
+        stat = os.stat(path)
+        row = self.connection.execute(
+            "SELECT mtime_ns, size, digest, signature FROM signatures WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[3], None
+
+        digest = None
+        if self.hash_content:
+            digest = self.file_digest(path)
+            # Same pixels under a new path or modification time, e.g. after being moved to processed_images
+            match = self.connection.execute(
+                "SELECT signature FROM signatures WHERE digest = ?", (digest,)).fetchone()
+            if match is not None:
+                self.connection.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?)",
+                                        (path, stat.st_mtime_ns, stat.st_size, digest, match[0]))
+                return match[0], None
+
+        return None, (stat.st_mtime_ns, stat.st_size, digest)
+
+    def update(self, paths, workers=None, chunk_size=64) -> dict:
+        # Returns path -> packed signature for every readable image, computing only new or changed ones
+        # A single image or a directory of them, like the detector's batch methods
+        if isinstance(paths, (str, os.PathLike)):
+            paths = os.fspath(paths)
+            paths = self.detector.list_images(paths) if os.path.isdir(paths) else [paths]
+
+        signatures = {}
+        missing = {}
+        with self.connection:
+            for path in paths:
+                try:
+                    blob, key = self._lookup(path)
+                except OSError as e:
+                    # e.g. moved or deleted since it was listed, the rest of the update still goes in
+                    logger.warning("Image skipped: %s", e)
+                    continue
+                if blob is not None:
+                    signatures[path] = blob
+                else:
+                    missing[path] = key
+
+        if missing:
+            logger.info("Computing %s new or changed signature(s)", len(missing))
+            with self.connection:
+                for path, signature in self.detector.color_signature_batch(
+                        list(missing), bin_width=self.bin_width, workers=workers, chunk_size=chunk_size):
+                    if signature is None:
+                        logger.warning("Unreadable image skipped: %s", path)
+                        continue
+                    blob = self.pack(signature)
+                    mtime_ns, size, digest = missing[path]
+                    self.connection.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?, ?, ?, ?)",
+                                            (path, mtime_ns, size, digest, blob))
+                    signatures[path] = blob
+
+        return signatures
+
+    def percentages(self, paths, detector=None, workers=None) -> dict:
+        # Yellowing percentage of every image for the bounds of detector, read from the signatures only
+        detector = detector or self.detector
+        signatures = self.update(paths, workers=workers)
+        names = list(signatures)
+        if not names:
+            return {}
+
+        # Every occupied bin of every image in one array, so all images are scored in a single pass
+        unpacked = [self.unpack(signatures[name]) for name in names]
+        indices = np.concatenate([bins for bins, _ in unpacked])
+        counts = np.concatenate([pixels for _, pixels in unpacked]).astype(np.float64)
+        owners = np.repeat(np.arange(len(names)), [len(bins) for bins, _ in unpacked])
+
+        yellow_weights, combined_weights = detector.signature_weights(self.bin_width)
+        yellow = np.bincount(owners, weights=counts * yellow_weights.ravel()[indices], minlength=len(names))
+        combined = np.bincount(owners, weights=counts * combined_weights.ravel()[indices], minlength=len(names))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result = np.where(combined > 0, yellow / combined * 100, 0.0)
+        return dict(zip(names, result.tolist()))
+
+    def sweep(self, healthy_paths, yellow_paths, thresholds=range(0, 101), detector=None) -> list:
+        # Detection rates for every threshold on labelled sets, yellowing is flagged at percentage >= threshold
+        healthy = np.array(list(self.percentages(healthy_paths, detector).values()))
+        yellow = np.array(list(self.percentages(yellow_paths, detector).values()))
+
+        results = []
+        for threshold in thresholds:
+            true_positive_rate = float(np.mean(yellow >= threshold)) if len(yellow) else 0.0
+            false_positive_rate = float(np.mean(healthy >= threshold)) if len(healthy) else 0.0
+            results.append({'threshold': threshold, 'true_positive_rate': true_positive_rate,
+                            'false_positive_rate': false_positive_rate})
+        return results
+
+    @staticmethod
+    def roc_auc(sweep) -> float:
+        # Area under the ROC curve traced by a threshold sweep
+        points = sorted((row['false_positive_rate'], row['true_positive_rate']) for row in sweep)
+        points = [(0.0, 0.0)] + points + [(1.0, 1.0)]
+        fpr, tpr = np.array(points).T
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def prune(self) -> int:
+        # Drop signatures of images that no longer exist
+        paths = [row[0] for row in self.connection.execute("SELECT path FROM signatures")]
+        gone = [(path,) for path in paths if not os.path.exists(path)]
+        with self.connection:
+            self.connection.executemany("DELETE FROM signatures WHERE path = ?", gone)
+        return len(gone)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep yellowing thresholds on labelled images using cached signatures")
+    parser.add_argument('--healthy', default="archive2/BPLD/healthy")
+    parser.add_argument('--yellow', default="archive2/BPLD/yellow mosaic")
+    parser.add_argument('--database', default='data/signatures.sqlite')
+    parser.add_argument('--bin-width', type=int, default=8)
+    parser.add_argument('--hash-content', action='store_true')
+    parser.add_argument('--lower-yellow', type=int, nargs=3, default=None)
+    parser.add_argument('--upper-yellow', type=int, nargs=3, default=None)
+    parser.add_argument('--output', default=None, help="save the sweep as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    yellow_detector = YellowDetector()
+    if args.lower_yellow:
+        yellow_detector.lower_yellow = tuple(args.lower_yellow)
+    if args.upper_yellow:
+        yellow_detector.upper_yellow = tuple(args.upper_yellow)
+
+    cache = SignatureCache(yellow_detector, database=args.database, bin_width=args.bin_width,
+                           hash_content=args.hash_content)
+    # Fill the cache first so the sweep below only measures the signature arithmetic
+    cache.update(yellow_detector.list_images(args.healthy) + yellow_detector.list_images(args.yellow))
+
+    start = time.perf_counter()
+    results = cache.sweep(yellow_detector.list_images(args.healthy), yellow_detector.list_images(args.yellow))
+    elapsed = time.perf_counter() - start
+
+    for row in results[::5]:
+        print(f"{row['threshold']:>3}% | detected {row['true_positive_rate'] * 100:5.1f}% of yellow, "
+              f"{row['false_positive_rate'] * 100:5.1f}% of healthy")
+    print(f"ROC AUC {cache.roc_auc(results):.3f}, swept {len(results)} thresholds in {elapsed * 1000:.0f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    cache.close()
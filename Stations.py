@@ -0,0 +1,166 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from Camera import Camera
+from Moisture import Moisture
+from Humidity import TempHumidity
+from Ph import Ph
+from Scheduler import FixedRateScheduler, SKIP
+from main import MonitoringSystem
+
+logger = logging.getLogger(__name__)
+
+# Per-station settings, anything not given in a station's config falls back to these
+STATION_DEFAULTS = {
+    'camera_index': 0,
+    'moisture_pin': 13,
+    'moisture_event_mode': True,
+    'dht_pin': 19,
+    'ph_channel': 0,
+    'led_pin': 6,
+    'interval': 10,
+    'camera_interval': None,
+    'sensor_timeouts': None,
+}
+
+
+class MultiStationMonitor:
+    def __init__(self, stations, data_handler, yellow_detector, health_model, image_writer=None, workers=2,
+                 scheduler=None, overrun_policy=SKIP, alert_duration=10, live_cache=None):
+        # stations is a list of config dicts, each with a unique 'name' and any STATION_DEFAULTS overrides
+        self.data_handler = data_handler
+        self.yellow_detector = yellow_detector
+        self.health_model = health_model
+        self.image_writer = image_writer
+        self.scheduler = scheduler or FixedRateScheduler()
+        # Shared by every station, entries and photos are kept apart by station name
+        self.live_cache = live_cache
+
+        # Capture, detection and prediction for every station share this bounded pool,
+        # the scheduler thread only hands work out
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Station")
+        # Sensor reads mostly block on the hardware, one thread per sensor keeps a slow one from holding up the rest
+        self.sensor_pool = ThreadPoolExecutor(max_workers=3 * max(len(stations), 1), thread_name_prefix="Sensor")
+
+        # task name -> future of its latest run, a task is never queued twice
+        self.lock = threading.Lock()
+        self.running = {}
+        self.skipped = {}
+
+        self.systems = []
+        for config in stations:
+            self.add_station(config, overrun_policy, alert_duration)
+
+    def add_station(self, config, overrun_policy=SKIP, alert_duration=10) -> MonitoringSystem:
+        settings = dict(STATION_DEFAULTS, **config)
+        name = settings['name']
+        if any(system.station == name for system in self.systems):
+            raise ValueError(f"Duplicate station name: {name}")
+
+        camera = Camera(image_writer=self.image_writer, camera_index=settings['camera_index'],
+                        name_suffix=f"_{name}")
+        system = MonitoringSystem(
+            data_handler=self.data_handler,
+            yellow_detector=self.yellow_detector,
+            camera=camera,
+            moisture=Moisture(sensor_pin=settings['moisture_pin'], event_mode=settings['moisture_event_mode']),
+            temp_humidity=TempHumidity(sensor_pin=settings['dht_pin']),
+            ph=Ph(channel=settings['ph_channel']),
+            health_model=self.health_model,
+            interval=settings['interval'],
+            led_pin=settings['led_pin'],
+            sensor_timeouts=settings['sensor_timeouts'],
+            alert_duration=alert_duration,
+            camera_interval=settings['camera_interval'],
+            scheduler=self.scheduler,
+            overrun_policy=overrun_policy,
+            station=name,
+            sensor_executor=self.sensor_pool,
+            live_cache=self.live_cache
+        )
+        self.systems.append(system)
+        return system
+
+    def dispatch(self, name, function):
+        def submit():
+            with self.lock:
+                previous = self.running.get(name)
+                if previous is not None and not previous.done():
+                    # Still busy with its last slot, drop this one like the scheduler's skip policy
+                    self.skipped[name] = self.skipped.get(name, 0) + 1
+                    logger.warning("%s still running, slot skipped", name)
+                    return
+                self.running[name] = self.pool.submit(self._run, name, function)
+        return submit
+
+    @staticmethod
+    def _run(name, function) -> None:
+        try:
+            function()
+        except Exception:
+            logger.exception("Station task %s failed", name)
+
+    def monitor(self) -> None:
+        for system in self.systems:
+            system.schedule(dispatch=self.dispatch)
+        self.scheduler.run()
+
+    def stop(self) -> None:
+        self.scheduler.stop()
+
+    def close(self) -> None:
+        # Let queued station work finish before the hardware goes away
+        self.pool.shutdown(wait=True)
+        for system in self.systems:
+            system.alert_scheduler.close()
+            system.sensor_reader.close()
+            system.camera.release_camera()
+            system.moisture.close()
+        self.sensor_pool.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    from DataHandler import DataHandler
+    from ColumnStore import ColumnStore
+    from HealthModel import HealthModel
+    from ImageLifecycle import ImageLifecycle
+    from ImageWriter import ImageWriter
+    from Metrics import metrics
+    from QueryServer import LiveCache, QueryServer
+    from YellowDetector import YellowDetector
+
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    metrics.start_exporter('data/metrics.prom', interval=60)
+
+    # One entry per plant, pins are BCM numbers and the pH probes share the MCP3008 on different channels
+    stations = [
+        {'name': 'plant1', 'camera_index': 0, 'moisture_pin': 13, 'dht_pin': 19, 'ph_channel': 0, 'led_pin': 6},
+        {'name': 'plant2', 'camera_index': 1, 'moisture_pin': 16, 'dht_pin': 20, 'ph_channel': 1, 'led_pin': 5},
+    ]
+
+    column_store = ColumnStore()
+    data_handler = DataHandler(flush_rows=6 * len(stations), flush_interval=60, rotate_daily=True,
+                               backends=[column_store], include_station=True)
+    image_writer = ImageWriter()
+    image_lifecycle = ImageLifecycle(max_age_days=365)
+    # e.g. /latest?station=plant2, older history comes from the column store filtered by station
+    live_cache = LiveCache(history_size=8640, column_store=column_store)
+    query_server = QueryServer(live_cache, port=8080)
+    monitor = MultiStationMonitor(stations, data_handler, YellowDetector(), HealthModel(compiled=True),
+                                  image_writer=image_writer, live_cache=live_cache)
+
+    try:
+        query_server.start()
+        image_lifecycle.start()
+        monitor.monitor()
+    finally:
+        query_server.close()
+        image_lifecycle.close()
+        metrics.close()
+        monitor.close()
+        # Make sure queued images and buffered rows reach the disk before exiting
+        image_writer.close()
+        data_handler.close()
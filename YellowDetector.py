@@ -1,47 +1,262 @@
+import logging
+import math
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import cv2
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Largest saturation x value bin count binned directly, finer bounds go through a lookup table
+MAX_UNIFORM_BINS = 64 * 64
+
+# Decoder flags for each supported reduction factor
+REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def _score_chunk(detector, paths) -> list:
+    # Runs inside a worker process, scores every image in the chunk
+    results = []
+    for path in paths:
+        try:
+            results.append((path, detector.detect_yellowing(path)))
+        except (ValueError, cv2.error):
+            # Unreadable or corrupt image, report it instead of failing the whole chunk
+            results.append((path, None))
+    return results
+
+
+def _signature_chunk(detector, bin_width, paths) -> list:
+    # Runs inside a worker process, computes the colour signature of every image in the chunk
+    results = []
+    for path in paths:
+        try:
+            results.append((path, detector.color_signature(path, bin_width=bin_width)))
+        except (ValueError, cv2.error):
+            results.append((path, None))
+    return results
+
 
 class YellowDetector:
-    def __init__(self):
+    def __init__(self, reduction=1, roi=None):
         self.lower_yellow = (15, 80, 100)
         self.upper_yellow = (40, 255, 255)
         self.lower_green = (35, 40, 40)
         self.upper_green = (85, 255, 255)
 
-    def detect_yellowing(self, image_path) -> float:
-        # Read the image
-        image = cv2.imread(image_path)
+        # Decode images at 1/2, 1/4 or 1/8 size, frames passed in are downscaled to match
+        if reduction not in REDUCED_READ_FLAGS:
+            raise ValueError(f"reduction must be one of {sorted(REDUCED_READ_FLAGS)}")
+        self.reduction = reduction
+        # Optional (x, y, width, height) region of interest in full-resolution pixels
+        self.roi = roi
+
+        # Histogram lookup tables, rebuilt whenever the colour bounds change
+        self._tables_bounds = None
+        self._tables = None
+
+        # Images per second achieved by the most recent batch run
+        self.last_batch_throughput = None
+
+    def load_image(self, image_path=None, image=None):
+        # Returns the BGR pixels to analyse and whether they may be overwritten in place
+        owned = image is None
         if image is None:
-            raise ValueError("The image path provided is invalid or the image could not be loaded.")
+            image = cv2.imread(image_path, REDUCED_READ_FLAGS[self.reduction])
+            if image is None:
+                raise ValueError("The image path provided is invalid or the image could not be loaded.")
+        elif self.reduction > 1:
+            image = cv2.resize(image, None, fx=1 / self.reduction, fy=1 / self.reduction,
+                               interpolation=cv2.INTER_AREA)
+            owned = True
+
+        if self.roi is not None:
+            x, y, width, height = (value // self.reduction for value in self.roi)
+            image = image[y:y + height, x:x + width]
+
+        return image, owned
+
+    def _bounds(self):
+        return self.lower_yellow, self.upper_yellow, self.lower_green, self.upper_green
+
+    def _histogram_tables(self):
+        # Saturation and value only matter relative to the bounds, so each is split into classes at
+        # the bound edges. A hue x class x class histogram then counts exactly the pixels
+        # cv2.inRange would select.
+        bounds = self._bounds()
+        if self._tables_bounds == bounds:
+            return self._tables
+
+        channel_edges = []
+        for channel in (1, 2):
+            channel_edges.append(sorted({edge for lower, upper in ((self.lower_yellow, self.upper_yellow),
+                                                                   (self.lower_green, self.upper_green))
+                                         for edge in (lower[channel], upper[channel] + 1) if 0 < edge < 256}))
+
+        # When the edges share a common step, equal-width bins of that step line up with every edge
+        # and calcHist can bin the HSV image directly. Otherwise a lookup table maps each value to its class first.
+        widths = [math.gcd(256, *edges) for edges in channel_edges]
+        if (256 // widths[0]) * (256 // widths[1]) <= MAX_UNIFORM_BINS:
+            lut = None
+            class_ranges = [(np.arange(0, 256, width), np.arange(width, 257, width) - 1) for width in widths]
+        else:
+            lut = np.zeros((256, 1, 3), dtype=np.uint8)
+            lut[:, 0, 0] = np.arange(256)  # hue is kept as is
+            class_ranges = []
+            for channel, edges in zip((1, 2), channel_edges):
+                lut[:, 0, channel] = np.searchsorted(edges, np.arange(256), side='right')
+                class_ranges.append((np.array([0] + edges), np.array(edges + [256]) - 1))
+
+        def selection(lower, upper):
+            hue = np.arange(180)
+            selected = (lower[0] <= hue) & (hue <= upper[0])
+            for channel, (starts, ends) in zip((1, 2), class_ranges):
+                inside = (lower[channel] <= starts) & (ends <= upper[channel])
+                selected = np.multiply.outer(selected, inside)
+            return selected.astype(bool)
 
-        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        yellow = selection(self.lower_yellow, self.upper_yellow)
+        green = selection(self.lower_green, self.upper_green)
+        self._tables = (lut, yellow, yellow | green)
+        self._tables_bounds = bounds
+        return self._tables
 
-        # create mask for green pixels
-        green_mask = cv2.inRange(hsv_image, self.lower_green, self.upper_green)
+    def color_histogram(self, image, owned=False):
+        # One hue x saturation x value histogram, computed in a single pass
+        lut, yellow, _ = self._histogram_tables()
+        s_bins, v_bins = yellow.shape[1], yellow.shape[2]
 
-        # create a mask for yellow pixels
-        yellow_mask = cv2.inRange(hsv_image, self.lower_yellow, self.upper_yellow)
+        # Convert in place when the pixels are ours to overwrite, never touch a caller's frame
+        in_place = owned and image.flags['C_CONTIGUOUS']
+        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=image if in_place else None)
 
-        # combine masks
-        combined_mask = cv2.bitwise_or(green_mask, yellow_mask)
+        if lut is None:
+            ranges = [0, 180, 0, 256, 0, 256]
+        else:
+            cv2.LUT(hsv_image, lut, dst=hsv_image)
+            ranges = [0, 180, 0, s_bins, 0, v_bins]
+
+        return cv2.calcHist([hsv_image], [0, 1, 2], None, [180, s_bins, v_bins], ranges)
+
+    def percentage_from_histogram(self, histogram) -> float:
+        _, yellow, combined = self._histogram_tables()
 
         # Get yellow pixels
-        yellow_pixels = np.sum(yellow_mask == 255)
+        yellow_pixels = float(histogram[yellow].sum())
 
         # calculate combined pixels
-        total_pixels = np.sum(combined_mask == 255)
+        total_pixels = float(histogram[combined].sum())
 
         # avoid division by zero
         if total_pixels == 0:
             return 0.0
 
         # calc percentage of yellow pixels in combined mask
-        yellow_percentage = (yellow_pixels / total_pixels) * 100
+        return (yellow_pixels / total_pixels) * 100
+
+    def detect_yellowing(self, image_path=None, image=None) -> float:
+        # Use the in-memory frame when given, otherwise read the image from disk
+        image, owned = self.load_image(image_path=image_path, image=image)
 
         # return percentage of yellowing detected in image
-        return yellow_percentage
+        return self.percentage_from_histogram(self.color_histogram(image, owned=owned))
+
+    def color_signature(self, image_path=None, image=None, bin_width=8):
+        # Histogram that doesn't depend on the colour bounds: every hue, saturation and value in bins of bin_width
+        image, owned = self.load_image(image_path=image_path, image=image)
+        in_place = owned and image.flags['C_CONTIGUOUS']
+        hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=image if in_place else None)
+        bins = 256 // bin_width
+        return cv2.calcHist([hsv_image], [0, 1, 2], None, [180, bins, bins], [0, 180, 0, 256, 0, 256])
+
+    @staticmethod
+    def _box_weights(lower, upper, bin_width):
+        # Fraction of each signature bin inside the box, assuming values are spread evenly within a bin
+        hue = np.arange(180)
+        weights = ((lower[0] <= hue) & (hue <= upper[0])).astype(np.float64)
+        starts = np.arange(0, 256, bin_width)
+        for channel in (1, 2):
+            overlap = np.minimum(upper[channel], starts + bin_width - 1) - np.maximum(lower[channel], starts) + 1
+            weights = np.multiply.outer(weights, np.clip(overlap, 0, bin_width) / bin_width)
+        return weights
+
+    def signature_weights(self, bin_width=8):
+        # Per-bin yellow and yellow-or-green weights, exact when every bound edge falls on a bin edge
+        yellow = self._box_weights(self.lower_yellow, self.upper_yellow, bin_width)
+        green = self._box_weights(self.lower_green, self.upper_green, bin_width)
+        overlap = self._box_weights(np.maximum(self.lower_yellow, self.lower_green),
+                                    np.minimum(self.upper_yellow, self.upper_green), bin_width)
+        return yellow, yellow + green - overlap
+
+    def percentage_from_signature(self, signature, bin_width=8) -> float:
+        yellow, combined = self.signature_weights(bin_width)
+        total_pixels = float((signature * combined).sum())
+        if total_pixels == 0:
+            return 0.0
+        return float((signature * yellow).sum()) / total_pixels * 100
+
+    @staticmethod
+    def list_images(directory) -> list:
+        # Sorted list of image files in a directory
+        return sorted(
+            os.path.join(directory, filename) for filename in os.listdir(directory)
+            if filename.lower().endswith(IMAGE_EXTENSIONS)
+        )
+
+    def detect_yellowing_batch(self, paths, workers=None, chunk_size=64):
+        # Yields (path, percentage) for every image, None for images that can't be read
+        yield from self._run_batch(_score_chunk, (self,), paths, workers, chunk_size, "Scored")
+
+    def color_signature_batch(self, paths, bin_width=8, workers=None, chunk_size=64):
+        # Yields (path, signature) for every image, None for images that can't be read
+        yield from self._run_batch(_signature_chunk, (self, bin_width), paths, workers, chunk_size, "Signed")
+
+    def _run_batch(self, chunk_function, arguments, paths, workers, chunk_size, verb):
+        # Accept a directory, a single image path or an iterable of image paths
+        if isinstance(paths, (str, os.PathLike)):
+            paths = os.fspath(paths)
+            paths = self.list_images(paths) if os.path.isdir(paths) else [paths]
+        paths = iter(paths)
+
+        workers = workers or os.cpu_count() or 1
+        # Keep a couple of chunks queued per worker so no core sits idle,
+        # without submitting the whole archive up front
+        max_pending = workers * 2
+
+        count = 0
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            exhausted = False
+            while pending or not exhausted:
+                while not exhausted and len(pending) < max_pending:
+                    chunk = [path for _, path in zip(range(chunk_size), paths)]
+                    if not chunk:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(chunk_function, *arguments, chunk))
+
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for result in future.result():
+                        count += 1
+                        yield result
+
+        elapsed = time.perf_counter() - start
+        rate = count / elapsed if elapsed > 0 else 0.0
+        self.last_batch_throughput = rate
+        logger.info("%s %s images in %.2fs (%.1f images/s, %s workers)", verb, count, elapsed, rate, workers)
 
 # if __name__ == "__main__":
 #     yellow_detector = YellowDetector()
@@ -1,3 +1,5 @@
+import logging
+import os
 from datetime import datetime
 
 from Camera import Camera
@@ -5,15 +7,26 @@ from Moisture import Moisture
 from Humidity import TempHumidity
 from Ph import Ph
 from DataHandler import DataHandler
+from ColumnStore import ColumnStore
 from YellowDetector import YellowDetector
-import time
+from ImageWriter import ImageWriter
+from ImageLifecycle import ImageLifecycle
 from HealthModel import HealthModel
-import RPi.GPIO as GPIO
+from SensorReader import SensorReader, MISSING
+from AlertScheduler import AlertScheduler
+from Scheduler import FixedRateScheduler, SKIP
+from Metrics import metrics
+from QueryServer import LiveCache, QueryServer
+from RollingWindow import RollingWindow
+
+logger = logging.getLogger(__name__)
 
 
 class MonitoringSystem:
     def __init__(self, data_handler, yellow_detector, camera, moisture, temp_humidity, ph, health_model, interval=86400,
-                 led_pin=17):
+                 led_pin=17, sensor_timeouts=None, alert_duration=10, camera_interval=None, scheduler=None,
+                 overrun_policy=SKIP, station=None, sensor_executor=None, rolling_window=None,
+                 live_cache=None):
         self.data_handler = data_handler
         self.yellow_detector = yellow_detector
         self.camera = camera
@@ -23,88 +36,203 @@ class MonitoringSystem:
         self.health_model = health_model
         self.interval = interval
         self.led_pin = led_pin
+        # Name written with every entry when several stations share one data handler
+        self.station = station
 
-        # Setup GPIO mode and pin
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.led_pin, GPIO.OUT)
-        GPIO.output(self.led_pin, GPIO.LOW)  # Start with LED off
+        # Photos can be taken at a slower rate than sensor samples, None keeps them in step
+        self.camera_interval = camera_interval
+        self.scheduler = scheduler or FixedRateScheduler()
+        self.overrun_policy = overrun_policy
 
-    def monitor(self):
-        while True:
-            # Get sensor readings
-            temp_humid_reading = self.temp_humidity.get_reading()
-            moisture_reading = self.moisture.get_moisture_reading()
-            ph_reading = self.ph.get_ph_reading()
-
-            # Take photo
-            image_filename = self.camera.take_photo()
-
-            # Check image for yellowing
-            yellowing = 0
-            yellow_percentage = self.yellow_detector.detect_yellowing(image_path=image_filename)
-
-            # Determine if enough yellowing present
-            if yellow_percentage >= 20:
-                yellowing = 1
-
-            entry = self.data_handler.create_data_entry(
-                temperature=temp_humid_reading['temperature'],
-                moisture=moisture_reading,
-                humidity=temp_humid_reading['humidity'],
-                ph=ph_reading,
-                image_name=image_filename,
-                yellowing=yellowing
-            )
-
-            print(f"ENTRY: {entry}")
+        # Recent readings with incrementally updated statistics, kept whenever the model uses them.
+        # A reading goes into the window every window_stride samples, the spacing the model was trained on
+        self.window_stride = 1
+        if health_model.temporal_features:
+            self.window_stride = health_model.window_stride(interval)
+            if rolling_window is None:
+                rolling_window = RollingWindow(health_model.window_size(health_model.window_interval))
+        self.rolling_window = rolling_window
+        self.samples = 0
+
+        # In-memory copy of recent entries and the latest photo for the query server, if one is running
+        self.live_cache = live_cache
+
+        # Result of the most recent photo
+        self.latest_image = None
+        self.latest_yellowing = None
+
+        # Read all sensors concurrently, each bounded by its own deadline in seconds
+        timeouts = {'temp_humidity': 15.0, 'moisture': 1.0, 'ph': 2.0}
+        timeouts.update(sensor_timeouts or {})
+        # Stations can share one thread pool for their sensor reads
+        self.sensor_reader = SensorReader(executor=sensor_executor)
+        self.sensor_reader.add_sensor('temp_humidity', self.temp_humidity.get_reading, timeouts['temp_humidity'])
+        self.sensor_reader.add_sensor('moisture', self.moisture.get_moisture_reading, timeouts['moisture'])
+        self.sensor_reader.add_sensor('ph', self.ph.get_ph_reading, timeouts['ph'])
+
+        # LED output runs on its own thread so alerts never block the loop
+        self.alert_duration = alert_duration
+        self.alert_scheduler = AlertScheduler(led_pin=self.led_pin)
+
+    def capture(self):
+        # Take photo, the JPEG is written in the background
+        with metrics.span('capture', station=self.station):
+            image_filename, frame = self.camera.take_photo(return_frame=True)
+        self.analyse_image(image_filename, frame)
+
+    def analyse_image(self, image_filename, frame):
+        # Check the captured frame for yellowing, no need to read it back from disk
+        yellowing = 0
+        with metrics.span('detect', station=self.station):
+            yellow_percentage = self.yellow_detector.detect_yellowing(image=frame)
+
+        # Determine if enough yellowing present
+        if yellow_percentage >= 20:
+            yellowing = 1
+
+        # Kept until the next photo, sensor samples in between reuse them
+        self.latest_image = image_filename
+        self.latest_yellowing = yellowing
+
+        if self.live_cache is not None:
+            self.live_cache.update_image(image_filename, frame, yellowing, station=self.station)
 
+    def sample(self):
+        # Get sensor readings, a slow or failing sensor is reported as stale or missing
+        with metrics.span('sensors', station=self.station):
+            readings, status = self.sensor_reader.read_all()
+        temp_humid_reading = readings['temp_humidity'] or {'temperature': None, 'humidity': None}
+        moisture_reading = readings['moisture']
+        ph_reading = readings['ph']
+
+        entry = self.data_handler.create_data_entry(
+            temperature=temp_humid_reading['temperature'],
+            moisture=moisture_reading,
+            humidity=temp_humid_reading['humidity'],
+            ph=ph_reading,
+            image_name=self.latest_image,
+            yellowing=self.latest_yellowing,
+            timestamp=self.entry_timestamp(),
+            station=self.station
+        )
+
+        if self.rolling_window is not None:
+            # O(1) per sample, the model sees the window without reading any history back
+            if self.samples % self.window_stride == 0:
+                entry.update(self.rolling_window.push(entry))
+            else:
+                entry.update(self.rolling_window.features())
+        self.samples += 1
+
+        logger.debug("ENTRY: %s", entry)
+
+        with metrics.span('persist', station=self.station):
             self.data_handler.write_data_entry(data=entry)
 
-            # Uncomment to test LED
-            # entry = {
-            #     'timestamp': datetime.now(),
-            #     'temperature': 22,
-            #     'humidity': 70,
-            #     'moisture': 1,
-            #     'ph': 7,
-            #     'yellowing': 1
-            # }
+        if self.live_cache is not None:
+            self.live_cache.update(entry)
+
+        # Uncomment to test LED
+        # entry = {
+        #     'timestamp': datetime.now(),
+        #     'temperature': 22,
+        #     'humidity': 70,
+        #     'moisture': 1,
+        #     'ph': 7,
+        #     'yellowing': 1
+        # }
+
+        # The model needs every input, skip the prediction for partial readings
+        missing = [name for name, state in status.items() if state == MISSING]
+        if missing:
+            logger.warning("Missing sensor readings: %s, skipping disease prediction", ', '.join(missing))
+            disease_detected = 0
+        else:
+            with metrics.span('predict', station=self.station):
+                disease_detected = self.health_model.predict_disease(entry=entry)
 
-            disease_detected = self.health_model.predict_disease(entry=entry)
+        if disease_detected or entry['yellowing']==1:
+            metrics.increment('disease_alerts_total', station=self.station)
+            logger.warning("DISEASE DETECTED")
+            self.turn_on_led()
 
-            if disease_detected or entry['yellowing']==1:
-                print("DISEASE DETECTED")
-                self.turn_on_led()
+        return entry
 
-            # Release the camera after use
-            self.camera.release_camera()
+    def entry_timestamp(self):
+        # Milliseconds on the scheduler's wall clock, so entries follow a virtual clock too
+        return int(self.scheduler.wall_clock() * 1000)
 
-            # Sleep for the interval before repeating the process
-            time.sleep(self.interval)
+    def run_cycle(self):
+        # One full cycle: photo, then sensors
+        with metrics.span('cycle', station=self.station):
+            self.capture()
+            return self.sample()
 
-            # Re-initialize the camera before the next photo
-            self.camera = Camera()
+    def schedule(self, dispatch=None):
+        # Adds this system's tasks to the scheduler, dispatch(name, function) can wrap each one,
+        # e.g. to hand the work to a shared pool instead of running it on the scheduler thread
+        dispatch = dispatch or (lambda name, function: function)
+        prefix = f"{self.station}:" if self.station else ''
+
+        if self.camera_interval is None or self.camera_interval == self.interval:
+            self.scheduler.add_task(prefix + 'cycle', dispatch(prefix + 'cycle', self.run_cycle), self.interval,
+                                    policy=self.overrun_policy)
+        else:
+            # Take a first photo so samples before the first camera slot have a yellowing value,
+            # unless the camera task runs straight away anyway
+            if not self.scheduler.run_immediately:
+                self.capture()
+            # The camera task is added first so it runs before the sensors when both are due
+            self.scheduler.add_task(prefix + 'camera', dispatch(prefix + 'camera', self.capture),
+                                    self.camera_interval, policy=self.overrun_policy)
+            self.scheduler.add_task(prefix + 'sensors', dispatch(prefix + 'sensors', self.sample), self.interval,
+                                    policy=self.overrun_policy)
+
+    def monitor(self):
+        # Cycles run on a fixed-rate grid, the camera stays open and is drained before each photo
+        self.schedule()
+        self.scheduler.run()
 
     def turn_on_led(self):
-        GPIO.output(self.led_pin, GPIO.HIGH)
-        print("LED ON")
-        time.sleep(10)  # Keep the LED on for 10 seconds
-        GPIO.output(self.led_pin, GPIO.LOW)
+        # Queue the alert and return straight away, repeated detections are de-duplicated
+        self.alert_scheduler.notify(key='disease', duration=self.alert_duration)
 
 
 # Main execution
 if __name__ == '__main__':
-    data_handler = DataHandler()
+    # LOG_LEVEL=DEBUG brings back every reading on the console, INFO keeps to start-up and problems
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # Stage timings are scraped from this file, e.g. by node_exporter's textfile collector
+    metrics.start_exporter('data/metrics.prom', interval=60)
+
+    # Rows are group-committed every minute or 6 rows, one file per day,
+    # and mirrored into the column store for training and dashboards
+    column_store = ColumnStore()
+    data_handler = DataHandler(flush_rows=6, flush_interval=60, rotate_daily=True, backends=[column_store])
+    # Dashboards query the running process at http://127.0.0.1:8080 instead of reading the CSV,
+    # ranges older than the cached day come from the column store
+    live_cache = LiveCache(column_store=column_store)
+    query_server = QueryServer(live_cache, port=8080)
     yellow_detector = YellowDetector()
-    camera = Camera()
-    moisture = Moisture()
+    image_writer = ImageWriter()
+    camera = Camera(image_writer=image_writer)
+    # Analysed photos are compacted into processed_images/YYYY/MM/DD in the background, a year is kept
+    image_lifecycle = ImageLifecycle(unprocessed_folder=camera.unprocessed_images_folder,
+                                     processed_folder=camera.processed_images_folder, max_age_days=365)
+    # Wet/dry changes between samples are caught by an edge callback instead of being missed
+    moisture = Moisture(event_mode=True)
     temp_humidity = TempHumidity()
     ph = Ph()
-    health_model = HealthModel()
+    # Predictions come from a decision grid cached next to the model file, rebuilt when the model changes
+    health_model = HealthModel(compiled=True)
 
     # Frequency in seconds the process will run
     interval = 10
 
+    # Frequency in seconds photos are taken, None takes one every interval
+    camera_interval = None
+
     led_pin = 6 # bcm6 (Pin 31)
 
     # Create the monitoring system
@@ -117,7 +245,22 @@ if __name__ == '__main__':
         ph=ph,
         health_model=health_model,
         interval=interval,
-        led_pin=led_pin
+        led_pin=led_pin,
+        camera_interval=camera_interval,
+        live_cache=live_cache
     )
 
-    monitoring_system.monitor()
+    try:
+        query_server.start()
+        image_lifecycle.start()
+        monitoring_system.monitor()
+    finally:
+        query_server.close()
+        image_lifecycle.close()
+        metrics.close()
+        monitoring_system.alert_scheduler.close()
+        camera.release_camera()
+        moisture.close()
+        # Make sure queued images and buffered rows reach the disk before exiting
+        image_writer.close()
+        data_handler.close()